@@ -1,40 +1,70 @@
 import os
-import json
+import orjson
 import time
 import base64
 import re
+import io
+import pathlib
 import asyncio
-from typing import List, Dict, Any, Optional
+import hashlib
+import logging
+import threading
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Any, Optional, Tuple, AsyncGenerator
 from datetime import datetime
 from dotenv import load_dotenv
 
 # --- THIRD PARTY LIBS ---
 import pypdf 
-from groq import AsyncGroq
+import aiofiles
+import aiosqlite
+import numpy as np
+from cachetools import TTLCache, LRUCache
 from langchain_groq import ChatGroq
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, ToolMessage
 from langchain_core.tools import tool
 from pydantic import BaseModel, Field
 
-# --- OCR ENGINE (PaddleOCR) ---
+from ai_services import get_groq_client
+
+logger = logging.getLogger(__name__)
+
+# --- OCR ENGINE (PaddleOCR, runs in worker processes - see ocr_worker.py) ---
 try:
-    from paddleocr import PaddleOCR
-    # Initialize OCR Engine once (Global) to save RAM
-    ocr_engine = PaddleOCR(
-        use_angle_cls=True,
-        use_doc_orientation_classify=False,
-        use_doc_unwarping=False,
-        use_textline_orientation=False,
-        lang='en',
-        show_log=False 
-    )
+    import paddleocr  # noqa: F401  (availability check; engines are built per worker)
+    import ocr_worker
     OCR_AVAILABLE = True
 except ImportError:
     print("⚠️ PaddleOCR not found. OCR features will be disabled.")
     OCR_AVAILABLE = False
-except Exception as e:
-    print(f"⚠️ PaddleOCR Init Failed: {e}")
-    OCR_AVAILABLE = False
+
+# --- PDF RASTERIZER (PyMuPDF, for OCR of scanned pages) ---
+try:
+    import fitz
+    PDF_RASTER_AVAILABLE = True
+except ImportError:
+    print("⚠️ PyMuPDF not found. Scanned PDFs will be OCR'd as a whole file.")
+    PDF_RASTER_AVAILABLE = False
+
+# --- IMAGE RESIZER (Pillow, shrinks vision uploads) ---
+try:
+    from PIL import Image
+    PILLOW_AVAILABLE = True
+except ImportError:
+    print("⚠️ Pillow not found. Images will be sent to the vision model at full size.")
+    PILLOW_AVAILABLE = False
+
+# --- EMBEDDING MODEL (Semantic Cache) ---
+# The model itself is loaded on first use (see _get_embedder), not at import
+try:
+    from sentence_transformers import SentenceTransformer
+    EMBEDDINGS_AVAILABLE = True
+except ImportError:
+    logger.warning("sentence-transformers not found. Semantic cache will use exact matches only.")
+    EMBEDDINGS_AVAILABLE = False
 
 # --- PDF GENERATION ---
 from reportlab.lib import colors
@@ -58,79 +88,355 @@ llm = ChatGroq(
     temperature=0.3
 )
 
-# 2. Fast Client (Autocomplete - 8B for speed)
-fast_llm = ChatGroq(
-    groq_api_key=GROQ_API_KEY,
-    model_name="llama-3.1-8b-instant",
-    temperature=0.1
-)
-
-# 3. Vision & Audio Client
-groq_client = AsyncGroq(api_key=GROQ_API_KEY)
+# 2. Shared Groq Client (Autocomplete, Titles, Vision & Audio)
+# Same pooled client as ai_services (one connection pool per process); with_options
+# only changes retry/timeout defaults and keeps the underlying transport.
+# It is closed by ai_services.close_groq_client on shutdown.
+groq_client = get_groq_client().with_options(max_retries=2, timeout=30)
+
+FAST_MODEL = "llama-3.1-8b-instant"  # 8B for speed
+
+async def close_clients():
+    """Releases the title DB / OCR worker processes (FastAPI shutdown hook)."""
+    if _title_db is not None:
+        await _title_db.close()
+    if _ocr_pool is not None:
+        _ocr_pool.shutdown(wait=False, cancel_futures=True)
+
+async def _fast_complete(prompt: str, max_tokens: int, json_mode: bool = False, **kwargs) -> str:
+    """Helper: single-turn 8B call with plain dict messages (no LangChain wrapping)."""
+    if json_mode:
+        kwargs["response_format"] = {"type": "json_object"}
+    res = await groq_client.chat.completions.create(
+        model=FAST_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0.1, max_tokens=max_tokens,
+        **kwargs
+    )
+    return res.choices[0].message.content
 
 REPORTS_DIR = "static/reports"
 os.makedirs(REPORTS_DIR, exist_ok=True)
 
+OCR_CACHE_DIR = "static/ocr_cache"
+os.makedirs(OCR_CACHE_DIR, exist_ok=True)
+
 
 # ==========================================
 # 1. VISION & DOCUMENT ANALYSIS ENGINE
 # ==========================================
 
-def run_paddle_ocr(file_path: str) -> str:
-    """Helper: Runs PaddleOCR on a file."""
+# --- OCR PROCESS POOL ---
+# PaddleOCR holds the GIL for most of its runtime, so threads can't overlap it.
+# Each worker process preloads its own engine once (initializer). "spawn" keeps
+# workers from inheriting the server's sockets/threads and only imports ocr_worker.
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "2"))
+
+def _new_ocr_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=OCR_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=ocr_worker.init_ocr,
+    )
+
+_ocr_pool = _new_ocr_pool() if OCR_AVAILABLE else None
+_ocr_pool_lock = threading.Lock()
+
+def _submit_ocr(source):
+    """Helper: queues one image on the process pool, replacing the pool if a worker died."""
+    global _ocr_pool
+    try:
+        return _ocr_pool.submit(ocr_worker.run_ocr, source)
+    except BrokenProcessPool:
+        with _ocr_pool_lock:
+            if _ocr_pool._broken:
+                _ocr_pool = _new_ocr_pool()
+        return _ocr_pool.submit(ocr_worker.run_ocr, source)
+
+def run_paddle_ocr(source) -> str:
+    """Helper (blocking): Runs PaddleOCR on a file path or encoded image bytes in the process pool."""
     if not OCR_AVAILABLE: return "[System: OCR Module not installed]"
     try:
-        result = ocr_engine.ocr(file_path, cls=True)
-        extracted_text = []
-        if result and result[0]:
-            for line in result:
-                if line:
-                    for word_info in line:
-                        extracted_text.append(word_info[1][0])
-        full_text = "\n".join(extracted_text)
-        return full_text if full_text.strip() else "[OCR: No readable text found]"
-    except Exception as e:
+        return _submit_ocr(source).result()
+    except Exception as e:  # e.g. BrokenProcessPool if an engine failed to load
         return f"[OCR Error: {str(e)}]"
 
-async def analyze_document(file_path: str, mime_type: str) -> str:
-    """Reads PDFs (Text+OCR) and Images (Vision+OCR)."""
+# --- OCR / VISION RESULT CACHE (keyed by file content) ---
+# Re-uploads and re-analysis of the same report are common in chat flows.
+# Tier 1: in-process LRU. Tier 2: static/ocr_cache/{sha}.txt (survives restarts).
+_ocr_memo = LRUCache(maxsize=256)
+_ocr_memo_lock = threading.Lock()
+vision_cache = TTLCache(maxsize=512, ttl=3600)
+
+def content_hash(data: bytes) -> str:
+    """Helper: 128-bit blake2b digest of the raw file bytes."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def _read_source(source) -> bytes:
+    """Helper: raw bytes of a file path / image bytes source."""
+    if isinstance(source, (bytes, bytearray)): return bytes(source)
+    with open(source, "rb") as f:
+        return f.read()
+
+def _ocr_cache_get(sha: str) -> Optional[str]:
+    """Helper: memory -> disk lookup."""
+    with _ocr_memo_lock:
+        if sha in _ocr_memo: return _ocr_memo[sha]
+    cache_file = os.path.join(OCR_CACHE_DIR, f"{sha}.txt")
+    if not os.path.exists(cache_file): return None
+    with open(cache_file, "r", encoding="utf-8") as f:
+        text = f.read()
+    with _ocr_memo_lock:
+        _ocr_memo[sha] = text
+    return text
+
+def _ocr_cache_put(sha: str, text: str):
+    """Helper: stores an OCR result. Engine errors are never cached."""
+    if text.startswith("[OCR Error") or text.startswith("[System"): return
+    cache_file = os.path.join(OCR_CACHE_DIR, f"{sha}.txt")
+    tmp_file = f"{cache_file}.{threading.get_ident()}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_file, cache_file)  # Atomic: readers never see a partial file
+    with _ocr_memo_lock:
+        _ocr_memo[sha] = text
+
+# --- OCR MICRO-BATCHER ---
+# Concurrent OCR requests are coalesced (up to 8 items or 20ms). A dispatcher thread
+# resolves cache hits, de-duplicates identical content and fans the misses out
+# across the process pool. PaddleOCR 2.7's ocr() takes one image per call, so a
+# batch is spread over the workers rather than sent as a single list call.
+OCR_BATCH_SIZE = 8
+OCR_BATCH_WAIT = 0.02  # seconds
+_ocr_dispatch = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix="ocr-dispatch")
+_ocr_queue: Optional[asyncio.Queue] = None
+_ocr_batcher: Optional[asyncio.Task] = None
+
+def _ocr_batch_job(sources: list) -> List[str]:
+    """Helper (dispatch thread): runs one coalesced batch through cache + process pool."""
+    if not OCR_AVAILABLE: return ["[System: OCR Module not installed]"] * len(sources)
+    results: List[Optional[str]] = [None] * len(sources)
+    pending = {}  # sha -> (pool future, [result indices])
+    for idx, src in enumerate(sources):
+        try:
+            sha = content_hash(_read_source(src))
+        except Exception as e:
+            results[idx] = f"[OCR Error: {str(e)}]"
+            continue
+        cached = _ocr_cache_get(sha)
+        if cached is not None:
+            results[idx] = cached
+        elif sha in pending:
+            pending[sha][1].append(idx)
+        else:
+            pending[sha] = (_submit_ocr(src), [idx])
+
+    for sha, (job, indices) in pending.items():
+        try:
+            text = job.result()
+            _ocr_cache_put(sha, text)
+        except Exception as e:
+            text = f"[OCR Error: {str(e)}]"
+        for idx in indices:
+            results[idx] = text
+    return results
+
+def _resolve_batch(live: list, job: asyncio.Future):
+    """Callback (event loop): hands each caller its result."""
+    try:
+        results = job.result()
+    except Exception as e:
+        results = [f"[OCR Error: {str(e)}]"] * len(live)
+    for (_, fut), text in zip(live, results):
+        if not fut.done(): fut.set_result(text)
+
+async def _ocr_batch_loop(queue: asyncio.Queue):
+    """Background task: drains the queue in micro-batches; batches run concurrently."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + OCR_BATCH_WAIT
+        while len(batch) < OCR_BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0: break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        live = [(src, fut) for src, fut in batch if not fut.done()]  # Skip cancelled callers
+        if not live: continue
+        job = loop.run_in_executor(_ocr_dispatch, _ocr_batch_job, [src for src, _ in live])
+        job.add_done_callback(functools.partial(_resolve_batch, live))
+
+async def ocr_submit(source) -> str:
+    """Queues a file path / image bytes for OCR and waits for its batch to finish."""
+    global _ocr_queue, _ocr_batcher
+    if _ocr_batcher is None or _ocr_batcher.done():
+        _ocr_queue = asyncio.Queue()
+        _ocr_batcher = asyncio.create_task(_ocr_batch_loop(_ocr_queue))
+    fut = asyncio.get_running_loop().create_future()
+    _ocr_queue.put_nowait((source, fut))
+    return await fut
+
+# --- PDF PIPELINE: extract (threads) -> text vs OCR (in order) -> OCR batch ---
+PDF_TEXT_BUDGET = 6000    # Matches the analysis_context truncation bound
+PDF_MIN_PAGE_TEXT = 20    # Pages with less text than this are treated as scanned
+PDF_WORKERS = 4
+_pdf_pool = ThreadPoolExecutor(max_workers=PDF_WORKERS, thread_name_prefix="pdf-extract")
+
+def _extract_pages_worker(data: bytes, start: int, step: int, stop: threading.Event, loop, queue: asyncio.Queue):
+    """Stage 1 (thread): extracts every `step`-th page. Each worker owns its reader (pypdf isn't thread-safe)."""
+    try:
+        reader = pypdf.PdfReader(io.BytesIO(data))
+        for i in range(start, len(reader.pages), step):
+            if stop.is_set(): break
+            try:
+                text = reader.pages[i].extract_text() or ""
+            except Exception:
+                text = ""
+            loop.call_soon_threadsafe(queue.put_nowait, (i, text))
+    except Exception: pass
+    finally:
+        loop.call_soon_threadsafe(queue.put_nowait, None)  # Worker done
+
+async def extract_pdf_pages(file_path: str, data: Optional[bytes] = None) -> Tuple[Dict[int, str], List[int]]:
+    """
+    Stages 1+2: parallel page extraction, consumed strictly in page order.
+    Returns (text_by_page, scanned_pages) for the pages that fit the text budget.
+    Pass `data` when the caller already holds the file's bytes (skips the re-read).
+    """
+    if data is None:
+        async with aiofiles.open(file_path, "rb") as f:
+            data = await f.read()
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+    for w in range(PDF_WORKERS):
+        loop.run_in_executor(_pdf_pool, _extract_pages_worker, data, w, PDF_WORKERS, stop, loop, queue)
+
+    arrived, text_by_page, scanned = {}, {}, []
+    next_page, used, finished = 0, 0, 0
+    while finished < PDF_WORKERS:
+        item = await queue.get()
+        if item is None:
+            finished += 1
+            continue
+        arrived[item[0]] = item[1]
+
+        # Stage 2: decide text-vs-OCR per page, in order
+        while next_page in arrived:
+            text = arrived.pop(next_page)
+            if len(text.strip()) < PDF_MIN_PAGE_TEXT:
+                scanned.append(next_page)
+            else:
+                text_by_page[next_page] = text
+                used += len(text)
+            next_page += 1
+
+        # Early exit: no reason to parse pages that would be truncated away
+        if used >= PDF_TEXT_BUDGET:
+            stop.set()
+            break
+
+    return text_by_page, scanned
+
+def rasterize_pdf_pages(file_path: str, pages: List[int]) -> List[bytes]:
+    """Helper (thread): renders the given pages to PNG bytes for OCR."""
+    with fitz.open(file_path) as doc:
+        return [doc[i].get_pixmap(dpi=200).tobytes("png") for i in pages]
+
+async def ocr_pdf_pages(file_path: str, pages: List[int]) -> Dict[int, str]:
+    """Stage 3: rasterizes only the scanned pages and OCRs them one micro-batch at a time."""
+    results = {}
+    used = 0
+    for k in range(0, len(pages), OCR_BATCH_SIZE):
+        chunk = pages[k:k + OCR_BATCH_SIZE]
+        pngs = await asyncio.to_thread(rasterize_pdf_pages, file_path, chunk)
+        texts = await asyncio.gather(*(ocr_submit(png) for png in pngs))
+        for i, text in zip(chunk, texts):
+            if text.startswith("[OCR"): continue  # Blank page / engine error
+            results[i] = text
+            used += len(text)
+            if used >= PDF_TEXT_BUDGET: return results
+    return results
+
+VISION_MAX_SIDE = 1568  # The vision model downsamples beyond this anyway
+
+def _encode_for_vision(raw: bytes, mime_type: str) -> Tuple[str, str]:
+    """Helper (thread): downscales large images before base64, so far fewer bytes go upstream."""
+    if PILLOW_AVAILABLE:
+        try:
+            with Image.open(io.BytesIO(raw)) as img:
+                if max(img.size) > VISION_MAX_SIDE:
+                    img.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE))
+                    if img.mode not in ("RGB", "L"):
+                        img = img.convert("RGB")
+                    buf = io.BytesIO()
+                    img.save(buf, format="JPEG", quality=90)
+                    raw, mime_type = buf.getvalue(), "image/jpeg"
+        except Exception:
+            pass  # Not decodable by Pillow: send as-is
+    return base64.b64encode(raw).decode('ascii'), mime_type
+
+async def run_vision_analysis(file_path: str, mime_type: str, raw: Optional[bytes] = None) -> str:
+    """Helper: Sends the image to the Groq vision model."""
+    if raw is None:
+        async with aiofiles.open(file_path, "rb") as image_file:
+            raw = await image_file.read()
+    sha = content_hash(raw)
+    if sha in vision_cache: return vision_cache[sha]
+    encoded_string, mime_type = await asyncio.to_thread(_encode_for_vision, raw, mime_type)
+    del raw  # Drop the full-size buffer before the (slow) network call
+
+    vision_response = await groq_client.chat.completions.create(
+        model="llama-3.2-11b-vision-preview",
+        messages=[{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "Analyze this medical image. Identify scan type, findings, and abnormalities."},
+                {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{encoded_string}"}},
+            ],
+        }],
+        temperature=0.1, max_tokens=500
+    )
+    vision_text = vision_response.choices[0].message.content
+    vision_cache[sha] = vision_text
+    return vision_text
+
+async def analyze_document(file_path: str, mime_type: str, data: Optional[bytes] = None) -> str:
+    """
+    Reads PDFs (Text+OCR) and Images (Vision+OCR).
+    `data`: the file's bytes if the caller already has them (upload routes), so the
+    extract / OCR / vision steps don't each re-read the file from disk.
+    """
     try:
         analysis_context = ""
         # A. Handle PDF
         if "pdf" in mime_type:
-            raw_text = ""
-            try:
-                with open(file_path, 'rb') as f:
-                    reader = pypdf.PdfReader(f)
-                    for page in reader.pages:
-                        text = page.extract_text()
-                        if text: raw_text += text + "\n"
-            except Exception: pass
-            
-            if len(raw_text.strip()) < 50: # Scanned PDF Check
-                ocr_text = run_paddle_ocr(file_path)
-                analysis_context = f"[SYSTEM: Scanned PDF Content (via OCR)]:\n{ocr_text[:6000]}"
+            text_by_page, scanned = await extract_pdf_pages(file_path, data)
+
+            if scanned and OCR_AVAILABLE and PDF_RASTER_AVAILABLE:
+                text_by_page.update(await ocr_pdf_pages(file_path, scanned))
+            raw_text = "\n".join(text_by_page[i] for i in sorted(text_by_page))
+
+            if len(raw_text.strip()) < 50 and not PDF_RASTER_AVAILABLE: # Scanned PDF, no rasterizer
+                ocr_text = await ocr_submit(file_path)
+                analysis_context = f"[SYSTEM: Scanned PDF Content (via OCR)]:\n{ocr_text[:PDF_TEXT_BUDGET]}"
+            elif scanned:
+                analysis_context = f"[SYSTEM: PDF Content (scanned pages via OCR)]:\n{raw_text[:PDF_TEXT_BUDGET]}"
             else:
-                analysis_context = f"[SYSTEM: PDF Content]:\n{raw_text[:6000]}"
+                analysis_context = f"[SYSTEM: PDF Content]:\n{raw_text[:PDF_TEXT_BUDGET]}"
 
         # B. Handle Images
+        # OCR (CPU, batched OCR thread) and Vision (network) overlap: wall time is max(), not sum()
         elif "image" in mime_type:
-            ocr_text = run_paddle_ocr(file_path)
-            with open(file_path, "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-            
-            vision_response = await groq_client.chat.completions.create(
-                model="llama-3.2-11b-vision-preview",
-                messages=[{
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "Analyze this medical image. Identify scan type, findings, and abnormalities."},
-                        {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{encoded_string}"}},
-                    ],
-                }],
-                temperature=0.1, max_tokens=500
+            ocr_text, vision_text = await asyncio.gather(
+                ocr_submit(data if data is not None else file_path),
+                run_vision_analysis(file_path, mime_type, data),
             )
-            analysis_context = (f"[SYSTEM: Visual Analysis]: {vision_response.choices[0].message.content}\n\n"
+            analysis_context = (f"[SYSTEM: Visual Analysis]: {vision_text}\n\n"
                                 f"[SYSTEM: OCR Text]: {ocr_text}")
         else:
             analysis_context = f"[SYSTEM: User uploaded file of type {mime_type}]"
@@ -144,15 +450,171 @@ async def analyze_document(file_path: str, mime_type: str) -> str:
 # 2. AUTOCOMPLETE ENGINE (FIXED)
 # ==========================================
 
-async def get_text_suggestions(current_input: str) -> List[str]:
+class SemanticCache:
+    """
+    Two-tier cache for the 8B helper calls.
+    Tier 1: exact hit on the normalized input (blake2b key, TTL bound).
+    Tier 2: nearest neighbour over MiniLM embeddings (cosine >= threshold).
+    """
+
+    def __init__(self, threshold: float = 0.92, maxsize: int = 10_000, ttl: int = 3600):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.exact = TTLCache(maxsize=maxsize, ttl=ttl)
+
+        # Semantic tier: ring buffer, row i belongs to values[i] / stamps[i]
+        self.matrix: Optional[np.ndarray] = None
+        self.values: List[Optional[List[str]]] = [None] * maxsize
+        self.stamps = np.zeros(maxsize, dtype=np.float64)
+        self.size = 0
+        self.cursor = 0
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return hashlib.blake2b(text.lower().strip().encode("utf-8")).hexdigest()
+
+    _embedder = None
+    _embedder_lock = threading.Lock()
+
+    @classmethod
+    def _get_embedder(cls):
+        """
+        Internal: small local model (~80MB) used only to match near-duplicate autocomplete
+        inputs. Loaded on the first lookup so workers that never autocomplete don't pay
+        the load time / memory. Returns None if it can't be loaded.
+        """
+        global EMBEDDINGS_AVAILABLE
+        if cls._embedder is None and EMBEDDINGS_AVAILABLE:
+            with cls._embedder_lock:
+                if cls._embedder is None and EMBEDDINGS_AVAILABLE:
+                    try:
+                        cls._embedder = SentenceTransformer("all-MiniLM-L6-v2")
+                    except Exception:
+                        logger.exception("Embedding Model Init Failed. Semantic cache will use exact matches only.")
+                        EMBEDDINGS_AVAILABLE = False
+        return cls._embedder
+
+    @classmethod
+    def _embed(cls, text: str) -> Optional[np.ndarray]:
+        """Internal: unit-length embedding, or None without a model (runs in a thread)."""
+        model = cls._get_embedder()
+        return None if model is None else model.encode(text, normalize_embeddings=True)
+
+    async def lookup(self, text: str) -> Tuple[Optional[List[str]], Optional[np.ndarray]]:
+        """Returns (cached_value, embedding). The embedding is reused by store() on a miss."""
+        hit = self.exact.get(self._key(text))
+        if hit is not None:
+            return hit, None
+
+        if not EMBEDDINGS_AVAILABLE:
+            return None, None
+
+        # Encoding (and the first-use model load) is CPU work, keep it off the event loop
+        emb = await asyncio.to_thread(self._embed, text.lower().strip())
+        if emb is None:
+            return None, None
+        emb = emb.astype(np.float32)
+
+        if self.size:
+            scores = self.matrix[:self.size] @ emb  # unit vectors -> dot product == cosine
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold and time.time() - self.stamps[best] < self.ttl:
+                return self.values[best], emb
+
+        return None, emb
+
+    def store(self, text: str, value: List[str], emb: Optional[np.ndarray] = None):
+        self.exact[self._key(text)] = value
+        if emb is None:
+            return
+
+        if self.matrix is None:
+            self.matrix = np.zeros((self.maxsize, emb.shape[0]), dtype=np.float32)
+
+        # Overwrite the oldest slot once the buffer is full
+        i = self.cursor
+        self.matrix[i] = emb
+        self.values[i] = value
+        self.stamps[i] = time.time()
+        self.cursor = (i + 1) % self.maxsize
+        self.size = min(self.size + 1, self.maxsize)
+
+
+suggestion_cache = SemanticCache()
+smart_reply_cache = SemanticCache()
+
+
+# --- JSON-MODE SALVAGE ---
+# If Groq rejects a JSON-mode reply (400 json_validate_failed), the raw text comes
+# back as `failed_generation`; the string array inside is usually still usable.
+# Bounded char class: no DOTALL/greedy backtracking across the buffer.
+_JSON_ARR_RE = re.compile(r'\[[^\[\]]*\]')
+
+def _salvage_list(exc: Exception) -> List[str]:
+    """Helper: recovers a list of strings from a failed JSON-mode generation."""
+    body = getattr(exc, "body", None)
+    if isinstance(body, dict): body = body.get("error", body)
+    raw = body.get("failed_generation") if isinstance(body, dict) else None
+    if not raw: return []
+    match = _JSON_ARR_RE.search(raw)
+    if not match: return []
+    try:
+        items = orjson.loads(match.group(0))
+    except ValueError:
+        return []
+    return [str(i) for i in items if isinstance(i, str)]
+
+# --- SERVER-SIDE DEBOUNCE (latest keystroke wins) ---
+SUGGEST_DEBOUNCE = 0.12  # seconds
+_suggest_tasks: Dict[str, asyncio.Task] = {}
+
+async def get_text_suggestions(current_input: str, session_id: Optional[str] = None) -> List[str]:
+    """
+    Keystroke entry point. With a session_id, a newer request for the same
+    session cancels the older one; calls superseded within the debounce
+    window never reach Groq and return [].
+    """
+    if not session_id:
+        return await _generate_text_suggestions(current_input)
+
+    previous = _suggest_tasks.get(session_id)
+    if previous and not previous.done():
+        previous.cancel()
+
+    async def debounced():
+        await asyncio.sleep(SUGGEST_DEBOUNCE)
+        return await _generate_text_suggestions(current_input)
+
+    task = asyncio.create_task(debounced())
+    _suggest_tasks[session_id] = task
+    try:
+        # wait() (not `await task`) so a superseded task doesn't raise into this request
+        await asyncio.wait({task})
+    except asyncio.CancelledError:
+        task.cancel()  # Client went away: drop the pending call too
+        raise
+    finally:
+        if _suggest_tasks.get(session_id) is task:
+            del _suggest_tasks[session_id]
+
+    if task.cancelled(): return []
+    return task.result()
+
+async def _generate_text_suggestions(current_input: str) -> List[str]:
     """
     Studio-Grade Predictive Text Engine.
-    Uses Regex-based extraction to ensure stability even if the LLM 'yaps'.
+    Uses Groq JSON mode so the reply is always parseable (no regex salvage).
     """
     # 1. Validation: Don't autocomplete on empty/nonsense input
     if not current_input or len(current_input.strip()) < 2: 
         return []
 
+    # Cache: near-identical keystrokes skip the Groq round-trip entirely
+    cached, emb = await suggestion_cache.lookup(current_input)
+    if cached is not None:
+        return cached
+
     # 2. Strict Prompting
     prompt = f"""
     Role: Keyboard Autocomplete Engine.
@@ -160,33 +622,30 @@ async def get_text_suggestions(current_input: str) -> List[str]:
     Input: "{current_input}"
     
     Constraints:
-    - Return a JSON List of 3 strings.
+    - Return a JSON object: {{"suggestions": ["...", "...", "..."]}} with 3 strings.
     - NO polite talk. NO conversational filler.
     - The suggestions must strictly continue the input text.
     
     Example:
-    Input: "I feel d" -> Output: ["dizzy", "drained", "down lately"]
+    Input: "I feel d" -> Output: {{"suggestions": ["dizzy", "drained", "down lately"]}}
     """
 
     try:
         # 3. Execution
-        res = await fast_llm.ainvoke([HumanMessage(content=prompt)])
-        raw_content = res.content.strip()
-
-        # 4. Bulletproof Parsing (Regex)
-        # Finds anything that looks like ["..."] inside the response
-        match = re.search(r'\[.*\]', raw_content, re.DOTALL)
-        if match:
-            json_str = match.group(0)
-            suggestions = json.loads(json_str)
-            # Extra safety: ensure it's a list of strings
-            return [str(s) for s in suggestions if isinstance(s, str)][:3]
-        
-        return []
+        content = await _fast_complete(prompt, max_tokens=48, json_mode=True)  # 3 short strings + JSON wrapper
+
+        # 4. Parsing (JSON mode guarantees a valid object)
+        data = orjson.loads(content)
+        suggestions = data.get("suggestions", []) if isinstance(data, dict) else []
+        # Extra safety: ensure it's a list of strings
+        result = [str(s) for s in suggestions if isinstance(s, str)][:3]
+        if result:
+            suggestion_cache.store(current_input, result, emb)
+        return result
 
     except Exception as e:
         # Fail silently for autocomplete (don't break UI)
-        return []
+        return _salvage_list(e)[:3]
 
 
 async def generate_smart_replies(chat_history: list) -> List[str]:
@@ -209,35 +668,42 @@ async def generate_smart_replies(chat_history: list) -> List[str]:
             
     if not last_msg: return defaults
 
+    cache_key = str(last_msg)[:300]
+    cached, emb = await smart_reply_cache.lookup(cache_key)
+    if cached is not None:
+        return cached
+
     # 3. Dynamic Prompting
     prompt = f"""
     Role: UX Writing Assistant.
-    Context: The AI Doctor just said: "{last_msg[:300]}..."
+    Context: The AI Doctor just said: "{cache_key}..."
     
     Task: Generate 3 short, relevant 'Quick Reply' buttons for the patient.
     Rules:
     - Max 3-4 words per button.
     - Must directly answer the Doctor's question/statement.
-    - Return strictly JSON list.
+    - Return a JSON object: {{"suggestions": ["...", "...", "..."]}}
     
     Example:
     Doctor: "How long have you had the fever?"
-    Output: ["Since yesterday", "2 days", "A week"]
+    Output: {{"suggestions": ["Since yesterday", "2 days", "A week"]}}
     """
 
     try:
-        res = await fast_llm.ainvoke([HumanMessage(content=prompt)])
+        content = await _fast_complete(prompt, max_tokens=40, json_mode=True)
         
-        # 4. Regex Parsing (Same robustness logic)
-        match = re.search(r'\[.*\]', res.content.strip(), re.DOTALL)
-        if match:
-            options = json.loads(match.group(0))
-            return [str(o)[:20] for o in options][:3] # Truncate long buttons
+        # 4. Parsing (Same JSON-mode contract as autocomplete)
+        data = orjson.loads(content)
+        options = data.get("suggestions", []) if isinstance(data, dict) else []
+        result = [str(o)[:20] for o in options][:3] # Truncate long buttons
+        if result:
+            smart_reply_cache.store(cache_key, result, emb)
+            return result
             
         return defaults
 
-    except Exception:
-        return defaults
+    except Exception as e:
+        return [o[:20] for o in _salvage_list(e)][:3] or defaults
 
 # ==========================================
 # 3. PDF GENERATOR ENGINE ("JANE DOE" REPLICA)
@@ -247,41 +713,84 @@ async def generate_smart_replies(chat_history: list) -> List[str]:
 # 3. PDF GENERATOR ENGINE (HEIDI/JANE DOE REPLICA)
 # ==========================================
 
+# --- STYLES (built once at import; constant across reports) ---
+# Colors (Matched to Reference)
+TEAL_COLOR = colors.HexColor('#008B96') # The specific "Heidi" Teal
+TEXT_COLOR = colors.HexColor('#1f2937')
+GRAY_LABEL = colors.HexColor('#6b7280')
+LIGHT_BG = colors.HexColor('#f9fafb')
+BORDER_COLOR = colors.HexColor('#e5e7eb')
+
+# Page config
+PAGE_MARGIN = 40
+AVAILABLE_WIDTH = A4[0] - 2 * PAGE_MARGIN
+
+def _build_report_styles() -> Dict[str, ParagraphStyle]:
+    """Helper: Custom Paragraph Styles for MedicalReportGenerator."""
+    styles = getSampleStyleSheet()
+    s = {}
+    s['brand'] = ParagraphStyle('Brand', parent=styles['Heading1'], fontSize=22, textColor=TEAL_COLOR, fontName='Helvetica-Bold')
+    s['contact'] = ParagraphStyle('Contact', parent=styles['Normal'], fontSize=8, textColor=GRAY_LABEL, alignment=TA_RIGHT, leading=10)
+    s['title'] = ParagraphStyle('DocTitle', parent=styles['Heading2'], fontSize=16, textColor=TEXT_COLOR, fontName='Helvetica-Bold', spaceBefore=15, spaceAfter=20)
+    s['section'] = ParagraphStyle('Section', parent=styles['Heading3'], fontSize=11, textColor=TEAL_COLOR, fontName='Helvetica-Bold', spaceBefore=15, spaceAfter=8)
+    s['label'] = ParagraphStyle('Label', parent=styles['Normal'], fontSize=7, textColor=GRAY_LABEL, fontName='Helvetica', leading=8)
+    s['value'] = ParagraphStyle('Value', parent=styles['Normal'], fontSize=9, textColor=TEXT_COLOR, fontName='Helvetica', leading=11)
+    s['value_bold'] = ParagraphStyle('ValueBold', parent=s['value'], fontName='Helvetica-Bold')
+    s['body'] = ParagraphStyle('Body', parent=styles['Normal'], fontSize=9, textColor=TEXT_COLOR, leading=13)
+    s['note'] = ParagraphStyle('Note', parent=s['label'], alignment=TA_CENTER)
+    return s
+
+REPORT_STYLES = _build_report_styles()
+
+# Table styles (fixed shape, no per-report data)
+TS_HEADER = TableStyle([
+    ('VALIGN', (0,0), (-1,-1), 'TOP'),
+    ('ALIGN', (1,0), (1,0), 'RIGHT'),
+])
+TS_FIELD_CELL = TableStyle([
+    ('LEFTPADDING', (0,0), (-1,-1), 0),
+    ('BOTTOMPADDING', (0,0), (-1,-1), 1),
+    ('TOPPADDING', (0,1), (-1,1), 1),
+])
+TS_ADMIN = TableStyle([
+    ('VALIGN', (0,0), (-1,-1), 'TOP'),
+    ('LINEBELOW', (0,0), (-1,0), 0.5, BORDER_COLOR), # Line after Row 1
+    ('BOTTOMPADDING', (0,0), (-1,-1), 8),
+    ('TOPPADDING', (0,0), (-1,-1), 8),
+])
+TS_CRED = TableStyle([
+    ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
+    ('BOTTOMPADDING', (0,0), (-1,-1), 3),
+    ('LEFTPADDING', (0,0), (0,-1), 0),
+])
+TS_OBJECTIVE = TableStyle([
+    ('GRID', (0,0), (-1,-1), 0.5, BORDER_COLOR),
+    ('BACKGROUND', (0,0), (-1,0), LIGHT_BG), # Header Background
+    ('VALIGN', (0,0), (-1,-1), 'TOP'),
+    ('PADDING', (0,0), (-1,-1), 10),
+])
+TS_SIG_CELL = TableStyle([('LEFTPADDING',(0,0),(-1,-1),0)])
+TS_SIGNATURE = TableStyle([
+    ('LINEABOVE', (0,0), (-1,-1), 1, TEXT_COLOR), # The Signature Line
+    ('VALIGN', (0,0), (-1,-1), 'TOP'),
+    ('TOPPADDING', (0,0), (-1,-1), 10),
+])
+
 class MedicalReportGenerator:
     @staticmethod
     def create_pdf(filename: str, data: dict):
         file_path = os.path.join(REPORTS_DIR, filename)
         doc = SimpleDocTemplate(file_path, pagesize=A4, 
-                                rightMargin=40, leftMargin=40, 
-                                topMargin=40, bottomMargin=40)
+                                rightMargin=PAGE_MARGIN, leftMargin=PAGE_MARGIN, 
+                                topMargin=PAGE_MARGIN, bottomMargin=PAGE_MARGIN)
         
-        # --- 1. STYLES & METRICS ---
-        styles = getSampleStyleSheet()
-        
-        # Colors (Matched to Reference)
-        TEAL_COLOR = colors.HexColor('#008B96') # The specific "Heidi" Teal
-        TEXT_COLOR = colors.HexColor('#1f2937')
-        GRAY_LABEL = colors.HexColor('#6b7280')
-        LIGHT_BG = colors.HexColor('#f9fafb')
-        BORDER_COLOR = colors.HexColor('#e5e7eb')
-
-        # Custom Paragraph Styles
-        s_brand = ParagraphStyle('Brand', parent=styles['Heading1'], fontSize=22, textColor=TEAL_COLOR, fontName='Helvetica-Bold')
-        s_contact = ParagraphStyle('Contact', parent=styles['Normal'], fontSize=8, textColor=GRAY_LABEL, alignment=TA_RIGHT, leading=10)
-        
-        s_title = ParagraphStyle('DocTitle', parent=styles['Heading2'], fontSize=16, textColor=TEXT_COLOR, fontName='Helvetica-Bold', spaceBefore=15, spaceAfter=20)
-        
-        s_section = ParagraphStyle('Section', parent=styles['Heading3'], fontSize=11, textColor=TEAL_COLOR, fontName='Helvetica-Bold', spaceBefore=15, spaceAfter=8)
-        
-        s_label = ParagraphStyle('Label', parent=styles['Normal'], fontSize=7, textColor=GRAY_LABEL, fontName='Helvetica', leading=8)
-        s_value = ParagraphStyle('Value', parent=styles['Normal'], fontSize=9, textColor=TEXT_COLOR, fontName='Helvetica', leading=11)
-        s_value_bold = ParagraphStyle('ValueBold', parent=s_value, fontName='Helvetica-Bold')
-        
-        s_body = ParagraphStyle('Body', parent=styles['Normal'], fontSize=9, textColor=TEXT_COLOR, leading=13)
+        # --- 1. STYLES (module-level, see REPORT_STYLES) ---
+        st = REPORT_STYLES
+        s_brand, s_contact, s_title, s_section = st['brand'], st['contact'], st['title'], st['section']
+        s_label, s_value, s_value_bold, s_body = st['label'], st['value'], st['value_bold'], st['body']
 
         story = []
-        width, height = A4
-        available_width = width - 80
+        available_width = AVAILABLE_WIDTH
 
         # --- 2. HEADER SECTION ---
         # Logo Left | Contact Right
@@ -290,10 +799,7 @@ class MedicalReportGenerator:
              Paragraph("meditab.ai<br/>support@meditab.ai", s_contact)]
         ]
         t_header = Table(header_tbl_data, colWidths=[available_width * 0.7, available_width * 0.3])
-        t_header.setStyle(TableStyle([
-            ('VALIGN', (0,0), (-1,-1), 'TOP'),
-            ('ALIGN', (1,0), (1,0), 'RIGHT'),
-        ]))
+        t_header.setStyle(TS_HEADER)
         story.append(t_header)
         story.append(Spacer(1, 20))
         
@@ -327,11 +833,7 @@ class MedicalReportGenerator:
             # Inner tables for each cell to stack Label/Value vertically
             cells = []
             for item in row_data:
-                cells.append(Table([[item[0]], [item[1]]], style=[
-                    ('LEFTPADDING', (0,0), (-1,-1), 0),
-                    ('BOTTOMPADDING', (0,0), (-1,-1), 1),
-                    ('TOPPADDING', (0,1), (-1,1), 1),
-                ]))
+                cells.append(Table([[item[0]], [item[1]]], style=TS_FIELD_CELL))
             return cells
 
         admin_data = [
@@ -340,12 +842,7 @@ class MedicalReportGenerator:
         ]
         
         t_admin = Table(admin_data, colWidths=[available_width/3]*3)
-        t_admin.setStyle(TableStyle([
-            ('VALIGN', (0,0), (-1,-1), 'TOP'),
-            ('LINEBELOW', (0,0), (-1,0), 0.5, BORDER_COLOR), # Line after Row 1
-            ('BOTTOMPADDING', (0,0), (-1,-1), 8),
-            ('TOPPADDING', (0,0), (-1,-1), 8),
-        ]))
+        t_admin.setStyle(TS_ADMIN)
         story.append(t_admin)
         story.append(Spacer(1, 15))
 
@@ -359,11 +856,7 @@ class MedicalReportGenerator:
             [Paragraph("GP Credentials:", s_label), Paragraph("MD, FRACGP (AI Verified)", s_value)]
         ]
         t_cred = Table(cred_data, colWidths=[80, available_width-80])
-        t_cred.setStyle(TableStyle([
-            ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
-            ('BOTTOMPADDING', (0,0), (-1,-1), 3),
-            ('LEFTPADDING', (0,0), (0,-1), 0),
-        ]))
+        t_cred.setStyle(TS_CRED)
         story.append(t_cred)
         
         story.append(Spacer(1, 8))
@@ -403,12 +896,7 @@ class MedicalReportGenerator:
         ]
         
         t_obj = Table([obj_header, obj_row], colWidths=[available_width * 0.5, available_width * 0.5])
-        t_obj.setStyle(TableStyle([
-            ('GRID', (0,0), (-1,-1), 0.5, BORDER_COLOR),
-            ('BACKGROUND', (0,0), (-1,0), LIGHT_BG), # Header Background
-            ('VALIGN', (0,0), (-1,-1), 'TOP'),
-            ('PADDING', (0,0), (-1,-1), 10),
-        ]))
+        t_obj.setStyle(TS_OBJECTIVE)
         story.append(t_obj)
         story.append(Spacer(1, 20))
 
@@ -438,16 +926,12 @@ class MedicalReportGenerator:
         
         # Stack them
         sig_data = [
-            [Table([[sig_headers[0]], [sig_values[0]]], style=[('LEFTPADDING',(0,0),(-1,-1),0)]),
-             Table([[sig_headers[1]], [sig_values[1]]], style=[('LEFTPADDING',(0,0),(-1,-1),0)])]
+            [Table([[sig_headers[0]], [sig_values[0]]], style=TS_SIG_CELL),
+             Table([[sig_headers[1]], [sig_values[1]]], style=TS_SIG_CELL)]
         ]
         
         t_sig = Table(sig_data, colWidths=[available_width * 0.6, available_width * 0.4])
-        t_sig.setStyle(TableStyle([
-            ('LINEABOVE', (0,0), (-1,-1), 1, TEXT_COLOR), # The Signature Line
-            ('VALIGN', (0,0), (-1,-1), 'TOP'),
-            ('TOPPADDING', (0,0), (-1,-1), 10),
-        ]))
+        t_sig.setStyle(TS_SIGNATURE)
         story.append(t_sig)
         
         # --- FOOTER ---
@@ -455,13 +939,39 @@ class MedicalReportGenerator:
         story.append(Paragraph("meditab.ai  |  support@meditab.ai", s_contact))
         story.append(Spacer(1, 5))
         note = "Note: This document is AI-generated by Meditab Portal. Verify with primary clinical records."
-        story.append(Paragraph(note, ParagraphStyle('Note', parent=s_label, alignment=TA_CENTER)))
+        story.append(Paragraph(note, st['note']))
 
         doc.build(story)
         return file_path
 
+# --- REPORT CACHE (content-addressed) ---
+# The agent often re-invokes the tool with identical args (retries / re-summaries).
+# Filenames are a hash of the payload, so a repeat call just returns the existing file.
+_report_files = LRUCache(maxsize=256)  # filenames known to exist (skips the stat on hot keys)
+
+def _report_key(data: dict) -> str:
+    """Helper: content hash of the report payload (+ the day, since the PDF is dated)."""
+    payload = orjson.dumps({**data, "_date": datetime.now().strftime("%Y-%m-%d")}, option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(payload, digest_size=8).hexdigest()
+
+def _report_exists(filename: str) -> bool:
+    if filename in _report_files: return True
+    if os.path.exists(os.path.join(REPORTS_DIR, filename)):
+        _report_files[filename] = True
+        return True
+    return False
+
+def _render_report(filename: str, data: dict) -> str:
+    """Internal: renders to a temp name then renames, so a cache hit never sees a half-written PDF."""
+    tmp_name = f".{filename}.{time.time_ns()}.tmp"
+    tmp_path = MedicalReportGenerator.create_pdf(tmp_name, data)
+    final_path = os.path.join(REPORTS_DIR, filename)
+    os.replace(tmp_path, final_path)
+    _report_files[filename] = True
+    return final_path
+
 @tool
-def generate_hospital_pdf(
+async def generate_hospital_pdf(
     patient_name: str, 
     age: str,
     gender: str,
@@ -496,7 +1006,6 @@ def generate_hospital_pdf(
     try:
         # 1. Filename Hygiene
         safe_name = "".join(x for x in patient_name if x.isalnum())[:10]
-        filename = f"Report_{safe_name}_{int(time.time())}.pdf"
         
         # 2. Parse Medications
         med_list = [m.strip().title() for m in medications.replace('\n', ',').split(',') if m.strip()] if medications else ["None reported"]
@@ -516,8 +1025,10 @@ def generate_hospital_pdf(
             "recommendations": recommendations
         }
         
-        # 4. Generate
-        path = MedicalReportGenerator.create_pdf(filename, data)
+        # 4. Generate (ReportLab is pure CPU: build off the event loop) - unless cached
+        filename = f"Report_{safe_name}_{_report_key(data)}.pdf"
+        if not _report_exists(filename):
+            await asyncio.to_thread(_render_report, filename, data)
         return f"REPORT_GENERATED_AT: /static/reports/{filename}"
 
     except Exception as e:
@@ -531,13 +1042,10 @@ model_with_tools = llm.bind_tools([generate_hospital_pdf])
 # 4. MAIN CHAT LOGIC (RE-ACT AGENT)
 # ==========================================
 
-async def get_ai_response(db_history: list, new_user_message: str, user_role: str = "PATIENT", file_context: str = None) -> str:
-    """
-    Studio-Grade Orchestrator with Strict Data Validation.
-    """
-    
-    # 1. GATEKEEPER SYSTEM PROMPT
-    base_instructions = """
+# 1. GATEKEEPER SYSTEM PROMPT
+# Built once and sent byte-identical on every turn so Groq's prefix cache can reuse it.
+# Anything dynamic (file analysis, memory) goes at the END of the message list.
+BASE_SYSTEM = SystemMessage(content="""
     You are Meditab, an empathetic AI Health Assistant.
     
     **PROTOCOL 1: LANGUAGE MIRRORING**
@@ -561,32 +1069,146 @@ async def get_ai_response(db_history: list, new_user_message: str, user_role: st
     **PROTOCOL 4: DOCTOR SIMULATION**
     - When calling 'generate_hospital_pdf', fill 'Prognosis' and 'Opinion' by INFERRING from symptoms. 
     - NEVER leave fields blank.
+    """)
+
+# --- HISTORY WINDOW ---
+# Last HISTORY_KEEP messages go verbatim; everything older is folded into one rolling
+# summary (8B). The summary only advances in whole SUMMARY_BLOCK steps, so it stays
+# byte-identical for several turns and the prompt prefix remains cacheable.
+HISTORY_KEEP = 12
+SUMMARY_BLOCK = 12
+PROMPT_TOKEN_BUDGET = 4000
+_summary_cache = LRUCache(maxsize=2048)  # hash(summarized messages) -> summary
+
+try:
+    import tiktoken
+    _tok = tiktoken.get_encoding("cl100k_base")
+    def count_tokens(text: str) -> int: return len(_tok.encode(text))
+except Exception:
+    def count_tokens(text: str) -> int: return len(text) // 4 + 1  # Rough fallback
+
+def _merge_same_role(history: list) -> list:
+    """Helper: collapses consecutive messages from the same role into one."""
+    merged = []
+    for msg in history:
+        role, content = msg['role'], str(msg['content'])
+        if merged and merged[-1]['role'] == role:
+            merged[-1]['content'] += f"\n\n{content}"
+        else:
+            merged.append({'role': role, 'content': content})
+    return merged
+
+def _history_key(history: list) -> str:
+    return content_hash("\x1e".join(f"{m['role']}:{m['content']}" for m in history).encode("utf-8"))
+
+async def _summarize_history(history: list) -> str:
+    """Helper: rolling summary of `history` (block-aligned). Extends the previous block's summary when cached."""
+    key = _history_key(history)
+    if key in _summary_cache: return _summary_cache[key]
+
+    previous = _summary_cache.get(_history_key(history[:-SUMMARY_BLOCK])) if len(history) > SUMMARY_BLOCK else None
+    new_part = history[-SUMMARY_BLOCK:] if previous else history
+    transcript = "\n".join(f"{m['role'].upper()}: {m['content'][:400]}" for m in new_part)
+    prompt = f"""
+    Role: Clinical Scribe.
+    Task: Update the running summary of this patient conversation.
+    Previous summary: {previous or "(none)"}
+    New messages:
+    {transcript}
+
+    Constraints:
+    - Max 120 words. Keep patient identity, symptoms, durations, medications, files discussed and decisions.
+    - Return ONLY the summary text.
     """
-    
-    messages = [SystemMessage(content=base_instructions)]
-    
+    summary = (await _fast_complete(prompt, max_tokens=200)).strip()
+    _summary_cache[key] = summary
+    return summary
+
+async def _build_chat_messages(db_history: list, new_user_message: str, file_context: str = None) -> list:
+    """Helper: system prompt + (summary) + bounded history + the new user turn."""
+    history = _merge_same_role(db_history)
+
+    # 1. Fold everything before the verbatim window into the block-aligned summary
+    cut = max(0, len(history) - HISTORY_KEEP) // SUMMARY_BLOCK * SUMMARY_BLOCK
+    summary = None
+    if cut:
+        try:
+            summary = await _summarize_history(history[:cut])
+        except Exception:
+            logger.exception("History Summary Error")  # Fall back to the window alone
+    window = history[cut:]
+
+    # File analysis rides on the final user turn so the system + history prefix stays stable
+    user_content = new_user_message
     if file_context:
-        messages.append(SystemMessage(content=f"SYSTEM NOTICE: User file analysis:\n{file_context}"))
-
-    for msg in db_history:
+        user_content = f"{new_user_message}\n\n[Attached file analysis]:\n{file_context}"
+
+    # 2. Token budget: drop the oldest window messages until the prompt fits
+    fixed = count_tokens(BASE_SYSTEM.content) + count_tokens(user_content) + (count_tokens(summary) if summary else 0)
+    sizes = [count_tokens(m['content']) for m in window]
+    total = fixed + sum(sizes)
+    start = 0
+    while total > PROMPT_TOKEN_BUDGET and start < len(window):
+        total -= sizes[start]
+        start += 1
+    window = window[start:]
+
+    messages = [BASE_SYSTEM]
+    if summary:
+        messages.append(SystemMessage(content=f"[Summary of earlier conversation]:\n{summary}"))
+    for msg in window:
         role = HumanMessage if msg['role'] == 'user' else AIMessage
-        messages.append(role(content=str(msg['content'])))
-    
-    messages.append(HumanMessage(content=new_user_message))
+        messages.append(role(content=msg['content']))
+    messages.append(HumanMessage(content=user_content))
+    return messages
+
+def _start_speculative_tools(gathered, speculative: dict):
+    """Helper: launches each tool call whose accumulated args already parse as complete JSON."""
+    for tc in gathered.tool_call_chunks:
+        call_id = tc.get('id')
+        if tc.get('name') != 'generate_hospital_pdf' or not call_id or call_id in speculative:
+            continue
+        try:
+            args = orjson.loads(tc.get('args') or "")  # Strict parse: partial JSON raises
+        except ValueError:
+            continue
+        if isinstance(args, dict):
+            speculative[call_id] = (args, asyncio.create_task(generate_hospital_pdf.ainvoke(args)))
+
+async def stream_ai_response(db_history: list, new_user_message: str, user_role: str = "PATIENT", file_context: str = None) -> AsyncGenerator[str, None]:
+    """
+    Streaming Orchestrator: yields text tokens as Groq produces them.
+    Tool-call deltas are accumulated silently; once the turn ends the tool runs
+    and the follow-up answer is streamed the same way.
+    """
+    messages = await _build_chat_messages(db_history, new_user_message, file_context)
 
     # --- AGENT LOOP ---
+    # Speculative tools: a report build starts the moment its streamed args form
+    # complete JSON, overlapping with the rest of the first stream.
+    speculative: Dict[str, Tuple[dict, asyncio.Task]] = {}
     try:
-        response = await model_with_tools.ainvoke(messages)
+        gathered = None
+        async for chunk in model_with_tools.astream(messages):
+            gathered = chunk if gathered is None else gathered + chunk
+            if chunk.content: yield chunk.content
+            if chunk.tool_call_chunks:
+                _start_speculative_tools(gathered, speculative)
         
-        if response.tool_calls:
+        if gathered is not None and gathered.tool_calls:
             # Add the "intent" to history
-            messages.append(response) 
+            messages.append(gathered) 
             
-            for tool_call in response.tool_calls:
+            for tool_call in gathered.tool_calls:
                 if tool_call['name'] == 'generate_hospital_pdf':
                     try:
-                        # Execute Tool (which now has the Validation Layer)
-                        tool_result = generate_hospital_pdf.invoke(tool_call['args'])
+                        # Execute Tool (which now has the Validation Layer); reuse the early run if args match
+                        early = speculative.pop(tool_call['id'], None)
+                        if early and early[0] == tool_call['args']:
+                            tool_result = await early[1]
+                        else:
+                            if early: early[1].cancel()
+                            tool_result = await generate_hospital_pdf.ainvoke(tool_call['args'])
                     except Exception as e:
                         tool_result = f"Error: {str(e)}"
                     
@@ -598,29 +1220,39 @@ async def get_ai_response(db_history: list, new_user_message: str, user_role: st
                     ))
             
             # Final Response: LLM explains the result (or asks for the missing name)
-            final_response = await model_with_tools.ainvoke(messages)
-            return final_response.content
-        
-        return response.content
+            async for chunk in model_with_tools.astream(messages):
+                if chunk.content: yield chunk.content
 
     except Exception as e:
         print(f"AI Agent Error: {e}")
-        return "System is currently busy. Please try again."
+        yield "System is currently busy. Please try again."
+    finally:
+        for _, task in speculative.values():
+            task.cancel()  # Abandoned stream / unmatched args
+
+async def get_ai_response(db_history: list, new_user_message: str, user_role: str = "PATIENT", file_context: str = None) -> str:
+    """
+    Studio-Grade Orchestrator with Strict Data Validation.
+    Non-streaming callers (voice route) get the fully joined stream.
+    """
+    parts = [token async for token in stream_ai_response(db_history, new_user_message, user_role, file_context)]
+    return "".join(parts)
 
 # ==========================================
 # 5. UTILITIES
 # ==========================================
 
-async def transcribe_audio(file_path: str) -> str:
+async def transcribe_audio(file_path: str, data: Optional[bytes] = None) -> str:
     """
     Studio-grade transcription using Groq Whisper Large V3.
     Features:
     - Auto-language detection (Hindi/English/Gujarati support).
     - Medical context prompting for higher accuracy.
     - Robust file validation and error logging.
+    Pass `data` when the audio is already in memory: it's sent as-is (no disk read).
     """
     # 1. Validation: Ensure file exists before calling expensive API
-    if not file_path or not os.path.exists(file_path):
+    if data is None and (not file_path or not os.path.exists(file_path)):
         print(f"❌ [Audio Error]: File not found at {file_path}")
         return "(Error: Audio file missing)"
 
@@ -629,16 +1261,18 @@ async def transcribe_audio(file_path: str) -> str:
         # and mixed languages, significantly improving accuracy for Hinglish/Gujarati.
         medical_context = "Medical consultation, symptoms, diagnosis, patient history, hindi, gujarati, english mixed."
 
-        with open(file_path, "rb") as file:
-            # 3. Execution
-            transcription = await groq_client.audio.transcriptions.create(
-                file=(os.path.basename(file_path), file.read()), # Pass filename for better format detection
-                model="whisper-large-v3",
-                prompt=medical_context,  # <--- KEY UPGRADE
-                response_format="json",
-                # language="en",         # REMOVED: Enabled auto-detection for Indic languages
-                temperature=0.0          # Deterministic output (less hallucinations)
-            )
+        # 3. Execution
+        # A Path (not bytes) lets the SDK read the file via anyio, off the event loop
+        transcription = await groq_client.audio.transcriptions.create(
+            # Sent under its filename either way (format detection)
+            file=(os.path.basename(file_path), data) if data is not None else pathlib.Path(file_path),
+            model="whisper-large-v3",
+            prompt=medical_context,  # <--- KEY UPGRADE
+            response_format="json",
+            # language="en",         # REMOVED: Enabled auto-detection for Indic languages
+            temperature=0.0,         # Deterministic output (less hallucinations)
+            timeout=120              # Long recordings outlive the 30s client default
+        )
         
         # 4. output Cleaning
         text = transcription.text.strip()
@@ -653,6 +1287,46 @@ async def transcribe_audio(file_path: str) -> str:
         print(f"⚠️ [Transcription Failed]: {str(e)}")
         return "(Audio processing temporarily unavailable)"
 
+# --- TITLE CACHE ---
+# Demo prompts ("I have a headache", ...) recur constantly. Tier 1: in-process LRU.
+# Tier 2: SQLite (blake2b(key) -> title) so hits survive restarts.
+TITLE_CACHE_DB = os.getenv("TITLE_CACHE_DB", "title_cache.sqlite3")
+_title_db: Optional[aiosqlite.Connection] = None
+_title_db_lock = asyncio.Lock()
+
+async def _get_title_db() -> aiosqlite.Connection:
+    """Helper: lazily opens the shared title-cache connection."""
+    global _title_db
+    if _title_db is None:
+        async with _title_db_lock:
+            if _title_db is None:
+                db = await aiosqlite.connect(TITLE_CACHE_DB)
+                await db.execute("PRAGMA journal_mode=WAL")
+                await db.execute("CREATE TABLE IF NOT EXISTS chat_titles (key TEXT PRIMARY KEY, title TEXT NOT NULL)")
+                await db.commit()
+                _title_db = db
+    return _title_db
+
+async def _title_db_get(digest: str) -> Optional[str]:
+    """Helper: persistent lookup. Cache failures never block title generation."""
+    try:
+        db = await _get_title_db()
+        async with db.execute("SELECT title FROM chat_titles WHERE key = ?", (digest,)) as cur:
+            row = await cur.fetchone()
+        return row[0] if row else None
+    except Exception as e:
+        logger.warning("Title Cache Error: %s", e)
+        return None
+
+async def _title_db_put(digest: str, title: str):
+    """Helper: persistent store."""
+    try:
+        db = await _get_title_db()
+        await db.execute("INSERT OR REPLACE INTO chat_titles (key, title) VALUES (?, ?)", (digest, title))
+        await db.commit()
+    except Exception as e:
+        logger.warning("Title Cache Error: %s", e)
+
 async def generate_chat_title(message_content: str) -> str:
     """
     Generates a professional, concise (3-5 words) clinical title for the chat session.
@@ -662,9 +1336,37 @@ async def generate_chat_title(message_content: str) -> str:
     if not message_content or len(message_content.strip()) < 2: 
         return "New Consultation"
 
-    # 2. Input Prep: Clean formatting to save tokens and reduce confusion
+    # 2. Input Prep: Clean formatting to save tokens and reduce confusion.
+    # Case is kept for the prompt ("MRI" stays "MRI"); only the cache key is lowercased.
     clean_content = message_content[:250].replace("\n", " ").strip()
 
+    try:
+        return await _cached_title(clean_content.lower(), clean_content)
+    except Exception:
+        # 6. Observability: Log the error so you know if Groq fails
+        logger.exception("Title Generation Error")
+        return "Medical Consultation"
+
+_title_cache = LRUCache(maxsize=4096)
+
+async def _cached_title(key: str, clean_content: str) -> str:
+    """
+    Memory -> SQLite -> Groq, keyed on the normalized text only.
+    Raises on Groq failure / empty output so fallbacks are never cached.
+    """
+    title = _title_cache.get(key)
+    if title: return title
+
+    digest = content_hash(key.encode("utf-8"))
+    title = await _title_db_get(digest)
+    if not title:
+        title = await _generate_title(clean_content)
+        await _title_db_put(digest, title)
+    _title_cache[key] = title
+    return title
+
+async def _generate_title(clean_content: str) -> str:
+    """Helper: one Groq call for the title. Raises if the model returns nothing usable."""
     # 3. "Studio-Grade" Prompting
     # We strictly enforce format to prevent conversational replies.
     prompt = f"""
@@ -678,23 +1380,19 @@ async def generate_chat_title(message_content: str) -> str:
     - Return ONLY the text.
     """
 
-    try:
-        # 4. Execution
-        res = await fast_llm.ainvoke([HumanMessage(content=prompt)])
-        raw_title = res.content.strip()
-
-        # 5. Robust Sanitization Pipeline
-        # Removes "Title:", quotes, extra spaces, and trailing dots
-        clean_title = raw_title.replace('"', '').replace("'", "").strip().rstrip(".")
-        
-        # Handle cases where LLM might say "Title: The Title"
-        if clean_title.lower().startswith("title:"):
-            clean_title = clean_title[6:].strip()
-
-        # Final Fallback check (if LLM returned empty string)
-        return clean_title if clean_title else "Medical Consultation"
+    # 4. Execution
+    # A title is one line; stop before the model rambles
+    raw_title = (await _fast_complete(prompt, max_tokens=16, stop=["\n", "."])).strip()
 
-    except Exception as e:
-        # 6. Observability: Log the error so you know if Groq fails
-        print(f"⚠️ [Title Generation Error]: {str(e)}")
-        return "Medical Consultation"
\ No newline at end of file
+    # 5. Robust Sanitization Pipeline
+    # Removes "Title:", quotes, extra spaces, and trailing dots
+    clean_title = raw_title.replace('"', '').replace("'", "").strip().rstrip(".")
+    
+    # Handle cases where LLM might say "Title: The Title"
+    if clean_title.lower().startswith("title:"):
+        clean_title = clean_title[6:].strip()
+
+    # Empty output: raise so the caller's fallback is used and nothing gets cached
+    if not clean_title:
+        raise ValueError("empty title from model")
+    return clean_title
@@ -1,5 +1,10 @@
 import os
-import json
+import orjson
+import asyncio
+import pathlib
+import httpx
+from typing import List, Dict, AsyncIterator, Optional, Tuple
+from cachetools import LRUCache
 from dotenv import load_dotenv
 from groq import AsyncGroq
 
@@ -11,8 +16,23 @@ API_KEY = os.getenv("groq_api_key")
 if not API_KEY:
     raise ValueError("Missing 'groq_api_key' in .env file")
 
-# Initialize Async Client
-client = AsyncGroq(api_key=API_KEY)
+# Initialize Async Client (one per process, on an explicit keep-alive pool)
+# The SDK's default transport pools far fewer sockets than concurrent chat/whisper
+# calls need, so bursts serialize on handshakes. HTTP/2 multiplexes on top.
+_http = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=100, keepalive_expiry=60),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+)
+client = AsyncGroq(api_key=API_KEY, http_client=_http)
+
+def get_groq_client() -> AsyncGroq:
+    """Shared client: other modules should use this instead of creating their own AsyncGroq."""
+    return client
+
+async def close_groq_client():
+    """Closes the pooled connections (FastAPI shutdown hook)."""
+    await _http.aclose()
 
 # --- CONFIGURATION ---
 CHAT_MODEL = "llama-3.3-70b-versatile"
@@ -29,15 +49,35 @@ RULES:
 4. If the user types 'SUMMARIZE', you must stop chatting and output a STRICT JSON summary.
 """
 
-async def get_ai_response(db_history: list, new_user_message: str) -> str:
+# Appended (not interpolated) on SUMMARIZE turns so the SYSTEM_PROMPT + history
+# prefix stays byte-identical and keeps hitting the provider's prompt cache.
+SUMMARY_PROMPT = """
+The patient asked to SUMMARIZE. Output ONLY a JSON object for the doctor with keys:
+"chief_complaint", "symptoms" (list), "duration", "severity", "relevant_history", "follow_up_questions" (list).
+Use null for anything not mentioned. No diagnosis.
+"""
+
+def _is_summarize(message: str) -> bool:
+    return message.strip().upper() == "SUMMARIZE"
+
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+# --- SESSION MESSAGE CACHE ---
+# (user_id, session_id) -> [(role, content) tuples, number of DB history rows they cover]
+# Tuples are kept across turns; dicts are only built at the SDK boundary.
+# A hit skips re-formatting the whole history; a length mismatch (edited/foreign
+# history) falls back to a full rebuild.
+_session_msg_cache = LRUCache(maxsize=1024)
+
+def invalidate_session(user_id, session_id: str):
+    """Drops the cached prompt for a session (call when a session is closed/deleted)."""
+    _session_msg_cache.pop((user_id, session_id), None)
+
+def _build_history(db_history: list) -> list:
     """
-    Handles the chat logic using Groq:
-    1. Converts Database History -> Groq Messages Format
-    2. Sends request to Llama 3.3
+    Converts Database History -> (role, content) tuples (Groq roles)
     """
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT}
-    ]
+    turns = []
     
     # 1. Format History
     for msg in db_history:
@@ -49,22 +89,98 @@ async def get_ai_response(db_history: list, new_user_message: str) -> str:
             content = " ".join([str(p) for p in content])
         
         if role and content:
-            messages.append({"role": role, "content": content})
+            turns.append((role, content))
+    return turns
+
+def _to_messages(turns: list, *extra: dict) -> list:
+    """Helper: (role, content) tuples -> Groq message dicts, system prompt first."""
+    return [_SYSTEM_MSG, *[{"role": r, "content": c} for r, c in turns], *extra]
 
-    # 2. Append New Message
-    messages.append({"role": "user", "content": new_user_message})
+def _cached_history(db_history: list, session_key: Optional[Tuple]) -> list:
+    """Helper: formatted history for the session, rebuilt only on a miss."""
+    if session_key is None: return _build_history(db_history)
+    entry = _session_msg_cache.get(session_key)
+    if entry is None or entry[1] != len(db_history):
+        entry = [_build_history(db_history), len(db_history)]
+        _session_msg_cache[session_key] = entry
+    return entry[0]
+
+async def stream_ai_response(db_history: list, new_user_message: str, session_key: Optional[Tuple] = None) -> AsyncIterator[str]:
+    """
+    Streams the Llama 3.3 reply token by token (TTFT instead of full completion).
+    Routes can forward it directly, e.g. StreamingResponse(..., media_type="text/event-stream").
+    Pass session_key=(user_id, session_id) to reuse the formatted history across turns.
+    """
+    history = _cached_history(db_history, session_key)
+    user_msg = {"role": "user", "content": new_user_message}
 
     try:
-        completion = await client.chat.completions.create(
-            model=CHAT_MODEL,
-            messages=messages,
-            temperature=0.6,
-            max_tokens=1024
-        )
-        return completion.choices[0].message.content
+        if _is_summarize(new_user_message):
+            # Structured output: JSON mode guarantees parseable JSON (no stream in JSON mode)
+            completion = await client.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=_to_messages(history, {"role": "system", "content": SUMMARY_PROMPT}, user_msg),
+                temperature=0.2,
+                max_tokens=1024,
+                response_format={"type": "json_object"}
+            )
+            parts = [completion.choices[0].message.content or "{}"]
+            yield parts[0]
+        else:
+            completion = await client.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=_to_messages(history, user_msg),
+                temperature=0.6,
+                max_tokens=1024,
+                stream=True
+            )
+            parts = []
+            async for chunk in completion:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield parts[-1]
+
+        # Turn completed: extend the cached prompt to match the rows the route will save
+        entry = _session_msg_cache.get(session_key) if session_key is not None else None
+        if entry is not None and entry[0] is history:
+            history.append(("user", new_user_message))
+            history.append(("assistant", "".join(parts)))
+            entry[1] += 2
     except Exception as e:
         print(f"Groq Chat Error: {str(e)}")
-        return f"I'm having trouble connecting to my brain right now. Error: {str(e)}"
+        yield f"I'm having trouble connecting to my brain right now. Error: {str(e)}"
+
+async def get_ai_response(db_history: list, new_user_message: str, session_key: Optional[Tuple] = None) -> str:
+    """
+    Handles the chat logic using Groq (non-streaming callers):
+    joins the stream from stream_ai_response.
+    """
+    return "".join([token async for token in stream_ai_response(db_history, new_user_message, session_key)])
+
+HINGLISH_PROMPT = "You are a translator. Convert the following Hindi/Indian language text into Hinglish (Roman Script) exactly as it sounds. Do not translate the meaning to English, just the script. Output ONLY the converted text."
+
+async def _whisper(file_path: str) -> str:
+    """Helper: Audio -> Hindi/Source Text."""
+    # A Path (not bytes) lets the SDK read the file via anyio, off the event loop
+    transcription = await client.audio.transcriptions.create(
+        file=pathlib.Path(file_path),
+        model=AUDIO_MODEL,
+        language="hi", # Hinting Hindi improves accuracy for Indian context
+        response_format="json"
+    )
+    return transcription.text
+
+async def _to_hinglish(raw_text: str) -> str:
+    """Helper: Source Text -> Hinglish (Roman Script), realtime."""
+    conversion = await client.chat.completions.create(
+        model=CHAT_MODEL,
+        messages=[
+            {"role": "system", "content": HINGLISH_PROMPT},
+            {"role": "user", "content": raw_text}
+        ],
+        temperature=0.1
+    )
+    return conversion.choices[0].message.content.strip()
 
 async def transcribe_audio(file_path: str) -> str:
     """
@@ -75,32 +191,120 @@ async def transcribe_audio(file_path: str) -> str:
     try:
         # Step 1: Transcribe with Whisper
         print(f"Transcribing {file_path}...")
-        with open(file_path, "rb") as file:
-            transcription = await client.audio.transcriptions.create(
-                file=(file_path, file.read()),
-                model=AUDIO_MODEL,
-                language="hi", # Hinting Hindi improves accuracy for Indian context
-                response_format="json"
-            )
-        raw_text = transcription.text
+        raw_text = await _whisper(file_path)
         
         # Step 2: Convert to Hinglish using Llama
         # We use a specialized prompt for script conversion
         print("Converting to Hinglish...")
-        conversion = await client.chat.completions.create(
-            model=CHAT_MODEL,
-            messages=[
-                {
-                    "role": "system", 
-                    "content": "You are a translator. Convert the following Hindi/Indian language text into Hinglish (Roman Script) exactly as it sounds. Do not translate the meaning to English, just the script. Output ONLY the converted text."
-                },
-                {"role": "user", "content": raw_text}
-            ],
-            temperature=0.1
-        )
-        
-        return conversion.choices[0].message.content.strip()
+        return await _to_hinglish(raw_text)
 
     except Exception as e:
         print(f"Audio Processing Error: {str(e)}")
-        return f"Error processing audio: {str(e)}"
\ No newline at end of file
+        return f"Error processing audio: {str(e)}"
+
+# --- MULTI-FILE INTAKE (realtime) ---
+# Caps in-flight Whisper+Llama pipelines so a big upload doesn't trip Groq rate limits
+TRANSCRIBE_CONCURRENCY = 10
+_transcribe_slots = asyncio.Semaphore(TRANSCRIBE_CONCURRENCY)
+
+async def _transcribe_limited(file_path: str) -> str:
+    async with _transcribe_slots:
+        return await transcribe_audio(file_path)
+
+async def transcribe_many(file_paths: List[str]) -> List[str]:
+    """
+    Runs transcribe_audio for every file concurrently (order preserved).
+    Wall-clock is roughly the slowest file instead of the sum; use
+    transcribe_audio_batch instead when latency doesn't matter.
+    """
+    results = await asyncio.gather(*(_transcribe_limited(p) for p in file_paths), return_exceptions=True)
+    return [
+        r if isinstance(r, str) else f"Error processing audio: {str(r)}"
+        for r in results
+    ]
+
+# --- BULK PATH (Groq Batch API) ---
+BATCH_POLL_START = 2.0   # seconds, doubled after every poll
+BATCH_POLL_MAX = 60.0
+BATCH_TERMINAL = {"completed", "failed", "expired", "cancelled"}
+
+async def _run_chat_batch(requests: Dict[str, dict]) -> Dict[str, str]:
+    """
+    Submits {custom_id: chat body} as one JSONL batch job and waits for it.
+    Returns {custom_id: assistant text} for the lines that succeeded.
+    """
+    jsonl = b"\n".join(
+        orjson.dumps({"custom_id": cid, "method": "POST", "url": "/v1/chat/completions", "body": body})
+        for cid, body in requests.items()
+    )
+    upload = await client.files.create(file=("hinglish_batch.jsonl", jsonl), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=upload.id, endpoint="/v1/chat/completions", completion_window="24h"
+    )
+
+    # Poll with exponential backoff
+    delay = BATCH_POLL_START
+    while batch.status not in BATCH_TERMINAL:
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, BATCH_POLL_MAX)
+        batch = await client.batches.retrieve(batch.id)
+
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"Batch {batch.id} ended with status '{batch.status}'")
+
+    output = await client.files.content(batch.output_file_id)
+    results = {}
+    for line in (await output.text()).splitlines():
+        if not line.strip(): continue
+        row = orjson.loads(line)
+        try:
+            results[row["custom_id"]] = row["response"]["body"]["choices"][0]["message"]["content"].strip()
+        except (KeyError, IndexError, TypeError):
+            continue  # Failed line: caller falls back to the raw transcript
+    return results
+
+async def transcribe_audio_batch(file_paths: List[str]) -> List[str]:
+    """
+    Bulk intake: same output as transcribe_audio for every file, in order.
+    1. Whisper runs realtime and concurrently (the Batch API only accepts /v1/chat/completions).
+    2. All Hinglish conversions go out as ONE batch job instead of N chat calls.
+    Single files keep the realtime path.
+    """
+    if len(file_paths) < 2:
+        return [await transcribe_audio(p) for p in file_paths]
+
+    raw = await asyncio.gather(*(_whisper(p) for p in file_paths), return_exceptions=True)
+
+    results: List[str] = []
+    requests = {}
+    for i, text in enumerate(raw):
+        if isinstance(text, Exception):
+            print(f"Audio Processing Error: {str(text)}")
+            results.append(f"Error processing audio: {str(text)}")
+            continue
+        results.append(text)
+        if text.strip():
+            requests[f"audio-{i}"] = {
+                "model": CHAT_MODEL,
+                "messages": [
+                    {"role": "system", "content": HINGLISH_PROMPT},
+                    {"role": "user", "content": text}
+                ],
+                "temperature": 0.1,
+            }
+
+    if not requests: return results
+    try:
+        converted = await _run_chat_batch(requests)
+    except Exception as e:
+        # Batch unavailable: fall back to concurrent realtime conversion
+        print(f"Batch Conversion Error: {str(e)}")
+        ids = list(requests)
+        texts = await asyncio.gather(
+            *(_to_hinglish(requests[cid]["messages"][1]["content"]) for cid in ids), return_exceptions=True
+        )
+        converted = {cid: t for cid, t in zip(ids, texts) if isinstance(t, str)}
+
+    for cid, text in converted.items():
+        results[int(cid.split("-", 1)[1])] = text
+    return results
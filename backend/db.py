@@ -1,11 +1,44 @@
 import urllib.parse
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
 import os
+import orjson
 from dotenv import load_dotenv
 load_dotenv()
 
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+def _async_url(url: str):
+    """Helper: same database, async driver (asyncpg / aiosqlite)."""
+    u = make_url(url)
+    u = u.set(drivername=ASYNC_DRIVERS.get(u.get_backend_name(), u.drivername))
+    if "sslmode" in u.query:  # libpq spelling -> asyncpg spelling
+        query = dict(u.query)
+        query["ssl"] = query.pop("sslmode")
+        u = u.set(query=query)
+    return u
+
+def _orjson_dumps(obj) -> str:
+    """Helper: orjson serializer for JSON columns (SQLAlchemy expects a str)."""
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
 DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_engine(DATABASE_URL)
+# JSON columns (chat messages etc.) are encoded/decoded with orjson instead of stdlib json
+engine = create_engine(DATABASE_URL, json_serializer=_orjson_dumps, json_deserializer=orjson.loads)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+
+# Async engine for the hot request paths (chat, auth): queries are awaited on the
+# event loop instead of blocking it / holding a threadpool worker.
+# The sync engine above stays for sqladmin, table creation and the remaining routes.
+_ASYNC_URL = _async_url(DATABASE_URL)
+# Pool sizing only applies to a real server pool (sqlite dev DBs use their own pool class)
+_ASYNC_POOL = dict(pool_size=20, max_overflow=10) if _ASYNC_URL.get_backend_name() == "postgresql" else {}
+async_engine = create_async_engine(
+    _ASYNC_URL, pool_pre_ping=True, **_ASYNC_POOL,
+    json_serializer=_orjson_dumps, json_deserializer=orjson.loads,
+)
+# expire_on_commit=False: rows stay readable after commit without a lazy (sync) refresh
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
\ No newline at end of file
@@ -1,7 +1,16 @@
 import os
-import pickle
+import json
+import orjson
+import asyncio
+import functools
+import heapq
 import mimetypes
-from googleapiclient.discovery import build
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.http import MediaFileUpload
@@ -16,7 +25,7 @@ def get_path(env_key, default_filename):
     
     if env_value:
         # If .env gives a full path, trust it. 
-        # If it gives just a filename (e.g. "token.pickle"), join it with current dir.
+        # If it gives just a filename (e.g. "token.json"), join it with current dir.
         if os.path.isabs(env_value):
             return env_value
         return os.path.join(CURRENT_DIR, env_value)
@@ -27,24 +36,66 @@ def get_path(env_key, default_filename):
 
 load_dotenv()
 
+# --- SHARED FOLDER-ID STORE (Redis, optional) ---
+# Folder IDs are permanent, so persisting them lets every worker / restart skip the
+# Drive search calls. Without REDIS_URL the in-process TTL cache is used alone.
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+REDIS_URL = os.getenv("REDIS_URL")
+FOLDER_KEY_PREFIX = "drive:folder:"
+
+@functools.lru_cache(maxsize=1)
+def _drive_discovery_doc():
+    """Helper: Drive v3 discovery document, parsed once from the copy bundled with googleapiclient."""
+    doc = get_static_doc('drive', 'v3')
+    return orjson.loads(doc) if doc else None
+
+
+def _escape_q(value):
+    """Helper: escapes a value for a single-quoted Drive q-string literal."""
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+
 class DriveAPI:
     SCOPES = ['https://www.googleapis.com/auth/drive']
     
     # Path configuration
     CREDENTIALS_FILE = get_path('GOOGLE_CREDENTIALS_FILE', 'credentials.json')
-    TOKEN_FILE = get_path('GOOGLE_TOKEN_FILE', 'token.pickle')
+    # Token is stored as JSON; an older 'token.pickle' (same base name) is migrated once
+    TOKEN_FILE = os.path.splitext(get_path('GOOGLE_TOKEN_FILE', 'token.json'))[0] + '.json'
+    LEGACY_TOKEN_FILE = os.path.splitext(TOKEN_FILE)[0] + '.pickle'
     
     # The Master Folder Name
     ROOT_FOLDER_NAME = "medical_portal"
 
+    # Max "'<id>' in parents" clauses per list query (keeps q under Drive's length limit)
+    PARENTS_PER_QUERY = 30
+
+    # Files up to this size go as a single multipart request; bigger ones use a
+    # resumable session (extra round-trip, but survives dropped connections)
+    RESUMABLE_THRESHOLD = 5 * 1024 * 1024
+    RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024  # must be a multiple of 256 KiB
+
     def __init__(self):
-        self.creds = None
-        if os.path.exists(self.TOKEN_FILE):
-            try:
-                with open(self.TOKEN_FILE, 'rb') as token:
-                    self.creds = pickle.load(token)
-            except Exception:
-                self.creds = None
+        # (parent_id, name) -> folder_id. Folder IDs never change, so a hit skips the lookup.
+        self._folder_cache = TTLCache(maxsize=4096, ttl=600)
+        self._folder_lock = threading.Lock()
+        # Serializes find-or-create so concurrent uploads can't create duplicate folders
+        self._hierarchy_lock = threading.Lock()
+        self.portal_id = None
+        # One Drive client per thread: httplib2 connections are not thread-safe
+        self._local = threading.local()
+        self._redis = None
+        if REDIS_AVAILABLE and REDIS_URL:
+            self._redis = redis.Redis.from_url(REDIS_URL, decode_responses=True, socket_timeout=0.5)
+        elif REDIS_URL:
+            print("⚠️ redis package not found. Drive folder IDs will only be cached in-process.")
+
+        self.creds = self._load_token()
 
         if not self.creds or not self.creds.valid:
             if self.creds and self.creds.expired and self.creds.refresh_token:
@@ -56,26 +107,71 @@ class DriveAPI:
             if not self.creds:
                 if not os.path.exists(self.CREDENTIALS_FILE):
                     print(f"[Drive] Error: Credentials file not found at {self.CREDENTIALS_FILE}")
-                    self.service = None
                     return
                 
                 flow = InstalledAppFlow.from_client_secrets_file(self.CREDENTIALS_FILE, self.SCOPES)
                 self.creds = flow.run_local_server(port=0)
             
-            with open(self.TOKEN_FILE, 'wb') as token:
-                pickle.dump(self.creds, token)
+            self._save_token()
+
+        if self.service: print("[Drive] Service Initialized Successfully")
+
+        # Bootstrap the portal root once instead of looking it up per upload
+        self.portal_id = self.get_or_create_folder(self.ROOT_FOLDER_NAME, 'root')
+
+    @property
+    def service(self):
+        """Drive client for the calling thread (built lazily from the shared credentials)."""
+        if not self.creds: return None
+        svc = getattr(self._local, "service", None)
+        if svc is None:
+            # No discovery round-trip: reuse the bundled doc (static_discovery as the fallback)
+            doc = _drive_discovery_doc()
+            if doc:
+                svc = build_from_document(doc, credentials=self.creds)
+            else:
+                svc = build('drive', 'v3', credentials=self.creds, static_discovery=True, cache_discovery=False)
+            self._local.service = svc
+        return svc
+
+    def _load_token(self):
+        """Internal: Reads the cached OAuth token (JSON), migrating a legacy pickle once."""
+        if os.path.exists(self.TOKEN_FILE):
+            try:
+                with open(self.TOKEN_FILE, 'r') as token:
+                    return Credentials.from_authorized_user_info(json.load(token), self.SCOPES)
+            except Exception:
+                return None
+
+        if os.path.exists(self.LEGACY_TOKEN_FILE):
+            try:
+                import pickle  # Legacy format only; never written again
+                with open(self.LEGACY_TOKEN_FILE, 'rb') as token:
+                    creds = pickle.load(token)
+                self.creds = creds
+                self._save_token()
+                print(f"[Drive] Migrated token to {self.TOKEN_FILE}")
+                return creds
+            except Exception as e:
+                print(f"[Drive] Legacy token migration failed: {e}")
+        return None
 
-        self.service = build('drive', 'v3', credentials=self.creds)
-        print("[Drive] Service Initialized Successfully")
+    def _save_token(self):
+        """Internal: Persists the OAuth token as JSON."""
+        with open(self.TOKEN_FILE, 'w') as token:
+            token.write(self.creds.to_json())
 
     def _get_folder_id(self, name, parent_id='root'):
-        """Internal: Finds a folder by name within a specific parent."""
-        safe_name = name.replace("'", "\\'")
-        query = f"mimeType='application/vnd.google-apps.folder' and name='{safe_name}' and '{parent_id}' in parents and trashed=false"
+        """Internal: Finds a folder by name within a specific parent (cached)."""
+        folder_id = self._cache_get(name, parent_id)
+        if folder_id: return folder_id
+        query = self._folder_query(name, parent_id)
         try:
-            results = self.service.files().list(q=query, fields="files(id, name)").execute()
+            results = self.service.files().list(q=query, fields="files(id)").execute()
             files = results.get('files', [])
-            return files[0]['id'] if files else None
+            folder_id = files[0]['id'] if files else None
+            self._cache_put(name, parent_id, folder_id)
+            return folder_id
         except Exception as e:
             print(f"[Drive Error] finding folder '{name}': {e}")
             return None
@@ -94,13 +190,97 @@ class DriveAPI:
             print(f"[Drive Error] creating folder '{name}': {e}")
             return None
 
+    def _cache_get(self, name, parent_id):
+        with self._folder_lock:
+            folder_id = self._folder_cache.get((parent_id, name))
+        if folder_id or not self._redis: return folder_id
+        try:
+            folder_id = self._redis.get(f"{FOLDER_KEY_PREFIX}{parent_id}:{name}")
+        except redis.RedisError as e:
+            print(f"⚠️ [Drive] Redis read failed: {e}")
+            return None
+        if folder_id:
+            with self._folder_lock:
+                self._folder_cache[(parent_id, name)] = folder_id
+        return folder_id
+
+    def _cache_put(self, name, parent_id, folder_id):
+        if not folder_id: return
+        with self._folder_lock:
+            self._folder_cache[(parent_id, name)] = folder_id
+        if not self._redis: return
+        key = f"{FOLDER_KEY_PREFIX}{parent_id}:{name}"
+        try:
+            # No TTL: IDs are permanent; the reverse key lets delete_file write through
+            self._redis.pipeline(transaction=False).set(key, folder_id).set(f"{FOLDER_KEY_PREFIX}id:{folder_id}", key).execute()
+        except redis.RedisError as e:
+            print(f"⚠️ [Drive] Redis write failed: {e}")
+
+    def _cache_bust(self, folder_id):
+        """Internal: drops every cached entry pointing at a deleted folder."""
+        with self._folder_lock:
+            for key in [k for k, v in self._folder_cache.items() if v == folder_id]:
+                self._folder_cache.pop(key, None)
+        if folder_id == self.portal_id:
+            self.portal_id = None
+        if not self._redis: return
+        try:
+            rev_key = f"{FOLDER_KEY_PREFIX}id:{folder_id}"
+            key = self._redis.get(rev_key)
+            if key: self._redis.delete(key, rev_key)
+        except redis.RedisError as e:
+            print(f"⚠️ [Drive] Redis delete failed: {e}")
+
     def get_or_create_folder(self, name, parent_id='root'):
         """Internal: atomic get-or-create operation."""
         folder_id = self._get_folder_id(name, parent_id)
         if not folder_id:
             folder_id = self._create_folder(name, parent_id)
+            self._cache_put(name, parent_id, folder_id)
         return folder_id
 
+    def _folder_query(self, name, parent_id=None):
+        """Internal: Drive q-string for a folder by name (optionally within a parent)."""
+        query = f"mimeType='application/vnd.google-apps.folder' and name='{_escape_q(name)}' and trashed=false"
+        if parent_id:
+            query += f" and '{parent_id}' in parents"
+        return query
+
+    def _resolve_user_and_session(self, portal_id, user_folder_name, session_name):
+        """
+        Internal: Finds/creates the Patient and Session folders.
+        Cold path resolves both with ONE files.list: the session folder is searched by
+        name alone (its parent isn't known yet) and matched on 'parents' afterwards.
+        """
+        user_folder_id = self._cache_get(user_folder_name, portal_id)
+        if user_folder_id:
+            return user_folder_id, self.get_or_create_folder(session_name, user_folder_id)
+
+        query = (
+            "mimeType='application/vnd.google-apps.folder' and trashed=false and "
+            f"((name='{_escape_q(user_folder_name)}' and '{portal_id}' in parents) or name='{_escape_q(session_name)}')"
+        )
+        try:
+            folders = self._list_all(query, "files(id, name, parents)")
+        except Exception as e:
+            # Failed lookup falls back to the sequential path (never blind-creates a duplicate)
+            print(f"[Drive Error] combined folder lookup: {e}")
+            user_folder_id = self.get_or_create_folder(user_folder_name, portal_id)
+            if not user_folder_id: return None, None
+            return user_folder_id, self.get_or_create_folder(session_name, user_folder_id)
+
+        user_folder_id = next(
+            (f['id'] for f in folders if f['name'] == user_folder_name and portal_id in f.get('parents', [])), None
+        ) or self._create_folder(user_folder_name, portal_id)
+        if not user_folder_id: return None, None
+        self._cache_put(user_folder_name, portal_id, user_folder_id)
+
+        session_folder_id = next(
+            (f['id'] for f in folders if f['name'] == session_name and user_folder_id in f.get('parents', [])), None
+        ) or self._create_folder(session_name, user_folder_id)
+        self._cache_put(session_name, user_folder_id, session_folder_id)
+        return user_folder_id, session_folder_id
+
     def upload_file_raw(self, file_path, original_filename, folder_id):
         """Internal: Basic file upload."""
         try:
@@ -108,7 +288,11 @@ class DriveAPI:
             if mime_type is None: mime_type = 'application/octet-stream'
 
             file_metadata = {'name': original_filename, 'parents': [folder_id]}
-            media = MediaFileUpload(file_path, mimetype=mime_type, resumable=True)
+            resumable = os.path.getsize(file_path) > self.RESUMABLE_THRESHOLD
+            media = MediaFileUpload(
+                file_path, mimetype=mime_type, resumable=resumable,
+                chunksize=self.RESUMABLE_CHUNK_SIZE if resumable else -1
+            )
 
             print(f"[Drive] Uploading '{original_filename}'...")
             file = self.service.files().create(
@@ -133,21 +317,28 @@ class DriveAPI:
         
         Note: 'user_email' arg here receives the 'user_hash' from routes.py
         """
+        session_folder_id = self.resolve_session_folder(user_email, session_id)
+        if not session_folder_id: return None
+
+        # 4. Upload
+        return self.upload_file_raw(file_path, file_name, session_folder_id)
+
+    def resolve_session_folder(self, user_email, session_id):
+        """
+        Finds/creates medical_portal -> Patient_<hash> -> <session_id> and returns the
+        session folder ID (None on failure). Resolve once when uploading several files.
+        """
         if not self.service: return None
 
         try:
-            # 1. Root Portal Folder
-            portal_id = self.get_or_create_folder(self.ROOT_FOLDER_NAME, 'root')
+            # 1. Root Portal Folder (bootstrapped in __init__)
+            portal_id = self.portal_id or self.get_or_create_folder(self.ROOT_FOLDER_NAME, 'root')
             
-            # 2. User Folder (Folder name: "Patient_<Hash>")
+            # 2+3. User Folder (Folder name: "Patient_<Hash>") and Session Folder
             user_folder_name = f"Patient_{user_email}"
-            user_folder_id = self.get_or_create_folder(user_folder_name, portal_id)
-            
-            # 3. Session Folder
-            session_folder_id = self.get_or_create_folder(session_id, user_folder_id)
-            
-            # 4. Upload
-            return self.upload_file_raw(file_path, file_name, session_folder_id)
+            with self._hierarchy_lock:
+                user_folder_id, session_folder_id = self._resolve_user_and_session(portal_id, user_folder_name, session_id)
+            return session_folder_id
             
         except Exception as e:
             print(f"[Drive Hierarchy Error]: {e}")
@@ -157,12 +348,25 @@ class DriveAPI:
         """Deletes a file or folder by ID."""
         try:
             self.service.files().delete(fileId=file_id).execute()
+            self._cache_bust(file_id)
             print(f"[Drive] Deleted file/folder: {file_id}")
             return True
         except Exception as e:
             print(f"[Drive Delete Error]: {e}")
             return False
     
+    def list_recent_files(self, page_size=20):
+        """Lists the most recent files across the whole Drive (admin/doctor views)."""
+        if not self.service: return []
+        try:
+            return self.service.files().list(
+                pageSize=page_size,
+                fields="nextPageToken, files(id, name, mimeType, webViewLink, createdTime)"
+            ).execute().get('files', [])
+        except Exception as e:
+            print(f"Error fetching from Drive: {e}")
+            return []
+
     # --- NEW: List Files for "Mini GDrive" View ---
     def list_patient_files(self, user_hash):
         """
@@ -173,7 +377,7 @@ class DriveAPI:
 
         try:
             # 1. Find Root > Portal > Patient Folder
-            portal_id = self._get_folder_id(self.ROOT_FOLDER_NAME, 'root')
+            portal_id = self.portal_id or self._get_folder_id(self.ROOT_FOLDER_NAME, 'root')
             if not portal_id: return []
 
             user_folder_name = f"Patient_{user_hash}"
@@ -217,17 +421,36 @@ class DriveAPI:
             print(f"[Drive List Error]: {e}")
             return []
 
+    def _list_all(self, query, fields, order_by=None):
+        """Internal: files().list with pagination (1000 per page), optionally sorted by Drive."""
+        results, page_token = [], None
+        extra = {"orderBy": order_by} if order_by else {}
+        while True:
+            resp = self.service.files().list(
+                q=query,
+                pageSize=1000,
+                fields=f"nextPageToken, {fields}",
+                pageToken=page_token,
+                **extra
+            ).execute()
+            results.extend(resp.get('files', []))
+            page_token = resp.get('nextPageToken')
+            if not page_token: return results
+
+    # Default per-file fields for get_all_files_for_user
+    USER_FILE_FIELDS = "files(id, name, mimeType, webViewLink, iconLink, size, createdTime, parents)"
+
     # RE-IMPLEMENTATION with precise logic:
-    def get_all_files_for_user(self, user_hash):
+    def get_all_files_for_user(self, user_hash, extra_q="", fields=USER_FILE_FIELDS):
         """
-        Retrieves all files inside 'Patient_<hash>' and its subfolders (Sessions).
+        Retrieves all files inside 'Patient_<hash>' and its subfolders (Sessions), newest first.
+        extra_q is ANDed into the Drive query (server-side filtering); fields narrows the response.
         """
         if not self.service: return []
         
-        files_list = []
         try:
             # 1. Get User Folder ID
-            portal_id = self._get_folder_id(self.ROOT_FOLDER_NAME, 'root')
+            portal_id = self.portal_id or self._get_folder_id(self.ROOT_FOLDER_NAME, 'root')
             if not portal_id: return []
             
             user_folder_id = self._get_folder_id(f"Patient_{user_hash}", portal_id)
@@ -235,23 +458,89 @@ class DriveAPI:
 
             # 2. Find all Session Folders inside User Folder
             q_sessions = f"'{user_folder_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
-            sessions = self.service.files().list(q=q_sessions, fields="files(id)").execute().get('files', [])
+            sessions = self._list_all(q_sessions, "files(id)")
             
             # 3. Build a query to find files in ANY of those session folders
-            # "parent_id in parents or parent_id2 in parents..."
+            # "parent_id in parents or parent_id2 in parents..." (one query instead of one per session)
             if not sessions: return []
             
-            # Batching queries or iterating (Safest to iterate for accuracy)
-            for sess in sessions:
-                q_files = f"'{sess['id']}' in parents and mimeType!='application/vnd.google-apps.folder' and trashed=false"
-                results = self.service.files().list(
-                    q=q_files, 
-                    fields="files(id, name, mimeType, webViewLink, iconLink, size, createdTime)"
-                ).execute()
-                files_list.extend(results.get('files', []))
-                
-            return files_list
+            # Chunked so each query stays under Drive's q-length limit.
+            # Drive sorts each chunk (orderBy); chunks are merged, not re-sorted.
+            runs = []
+            for i in range(0, len(sessions), self.PARENTS_PER_QUERY):
+                chunk = sessions[i:i + self.PARENTS_PER_QUERY]
+                parents_q = " or ".join(f"'{sess['id']}' in parents" for sess in chunk)
+                q_files = f"({parents_q}) and mimeType!='application/vnd.google-apps.folder' and trashed=false"
+                if extra_q: q_files += f" and {extra_q}"
+                runs.append(self._list_all(q_files, fields, order_by="createdTime desc"))
+
+            if len(runs) == 1: return runs[0]
+            return list(heapq.merge(*runs, key=lambda f: f.get('createdTime', ''), reverse=True))
 
         except Exception as e:
             print(f"[Drive Fetch Error]: {e}")
-            return []
\ No newline at end of file
+            return []
+
+
+# ==========================================
+# ASYNC FACADE
+# ==========================================
+# Dedicated pool for Drive I/O: slow uploads can't starve the default executor
+# (SMTP sends, file writes, other to_thread work), and each pool thread keeps
+# its own reusable Drive client (see DriveAPI.service).
+DRIVE_WORKERS = int(os.getenv("DRIVE_WORKERS", "8"))
+# Concurrent media uploads across all requests: Drive allows ~10 writes/s per user,
+# and capping below the pool size keeps threads free for listings/deletes
+DRIVE_UPLOAD_CONCURRENCY = int(os.getenv("DRIVE_UPLOAD_CONCURRENCY", "4"))
+
+class AsyncDriveAPI:
+    """
+    Async wrapper around DriveAPI for FastAPI routes.
+    Every googleapiclient .execute() is a blocking HTTPS call, so each method
+    runs in a Drive worker thread and the event loop stays free during uploads.
+    """
+
+    def __init__(self, sync_api: DriveAPI):
+        self._sync = sync_api
+        self._pool = ThreadPoolExecutor(max_workers=DRIVE_WORKERS, thread_name_prefix="drive")
+        self._upload_slots = asyncio.Semaphore(DRIVE_UPLOAD_CONCURRENCY)
+
+    async def _run(self, fn, *args, **kwargs):
+        """Internal: runs a blocking DriveAPI call on the Drive pool."""
+        return await asyncio.get_running_loop().run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+
+    @property
+    def service(self):
+        return self._sync.service
+
+    async def _upload(self, fn, *args, **kwargs):
+        """Internal: _run for uploads, bounded by DRIVE_UPLOAD_CONCURRENCY."""
+        async with self._upload_slots:
+            return await self._run(fn, *args, **kwargs)
+
+    async def upload_to_session_folder(self, *args, **kwargs):
+        return await self._upload(self._sync.upload_to_session_folder, *args, **kwargs)
+
+    async def upload_many_to_session_folder(self, user_email, session_id, files):
+        """
+        Uploads [(file_path, file_name), ...] into one session folder.
+        The folder hierarchy is resolved once, then the files upload concurrently.
+        Returns one result per file (None where an upload failed).
+        """
+        folder_id = await self._run(self._sync.resolve_session_folder, user_email, session_id)
+        if not folder_id: return [None] * len(files)
+        return await asyncio.gather(*(
+            self._upload(self._sync.upload_file_raw, path, name, folder_id) for path, name in files
+        ))
+
+    async def get_all_files_for_user(self, user_hash, extra_q="", fields=DriveAPI.USER_FILE_FIELDS):
+        return await self._run(self._sync.get_all_files_for_user, user_hash, extra_q, fields)
+
+    async def list_patient_files(self, user_hash):
+        return await self._run(self._sync.list_patient_files, user_hash)
+
+    async def list_recent_files(self, page_size=20):
+        return await self._run(self._sync.list_recent_files, page_size)
+
+    async def delete_file(self, file_id):
+        return await self._run(self._sync.delete_file, file_id)
@@ -1,8 +1,12 @@
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 import os
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
 
 # FastAPI Admin Imports
 from sqladmin import Admin
@@ -10,7 +14,8 @@ from sqladmin import Admin
 # Local Imports
 import models
 from db import engine
-from ai_services import get_ai_response, transcribe_audio 
+from ai_services import get_ai_response, transcribe_audio, close_groq_client
+import ai_new_services
 from utils import templates_dir, static_dir, AdminAuth, check_admin_access, static_dir
 from views import (
     UserAdmin, 
@@ -26,10 +31,74 @@ from views import (
 from routes import router
 
  
+# --- LOGGING ---
+# Handlers log to a queue; a background listener thread does the stdout writes, so
+# request handlers never block on container log backpressure. DEBUG records
+# (route-access diagnostics) are dropped unless LOG_LEVEL=DEBUG.
+_log_queue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = QueueListener(_log_queue, _log_stream)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), handlers=[QueueHandler(_log_queue)])
+log_listener.start()
+
 # --- INITIALIZATION ---
-models.Base.metadata.create_all(bind=engine)
+# Schema bootstrap (create_all, one-off column migrations, missing indexes) is opt-in:
+# running it from every worker at once races on the same DDL. Enable it on ONE
+# instance / release step only, e.g. AUTO_CREATE_TABLES=1 for a first deploy or
+# after model changes, then restart the workers without it.
+if os.getenv("AUTO_CREATE_TABLES", "0") == "1":
+    with engine.begin() as conn:
+        models.Base.metadata.create_all(bind=conn)
+        # One-off upgrade for older databases: chat_history.messages json -> jsonb
+        # (create_all never alters existing columns, and the GIN index needs jsonb)
+        if conn.dialect.name == "postgresql":
+            conn.exec_driver_sql("""
+                DO $$ BEGIN
+                    IF (SELECT data_type FROM information_schema.columns
+                        WHERE table_name = 'chat_history' AND column_name = 'messages') = 'json' THEN
+                        ALTER TABLE chat_history ALTER COLUMN messages TYPE jsonb USING messages::jsonb;
+                    END IF;
+                END $$;
+            """)
+            # medical_sessions.session_uuid: varchar -> native uuid (left as-is if old rows don't parse)
+            conn.exec_driver_sql("""
+                DO $$ BEGIN
+                    IF (SELECT data_type FROM information_schema.columns
+                        WHERE table_name = 'medical_sessions' AND column_name = 'session_uuid') = 'character varying' THEN
+                        ALTER TABLE medical_sessions ALTER COLUMN session_uuid TYPE uuid USING NULLIF(session_uuid, '')::uuid;
+                    END IF;
+                EXCEPTION WHEN invalid_text_representation THEN
+                    RAISE NOTICE 'session_uuid kept as varchar: existing values are not UUIDs';
+                END $$;
+            """)
+            # created_at moved from Python (naive datetime.utcnow) to a DB-side now() on
+            # timestamptz. Old naive values were UTC. Only ALTERs (ACCESS EXCLUSIVE lock)
+            # tables that still have the old column type.
+            conn.exec_driver_sql("""
+                DO $$ DECLARE t text; BEGIN
+                    FOREACH t IN ARRAY ARRAY['medical_cases', 'chat_history', 'medical_media'] LOOP
+                        IF (SELECT data_type FROM information_schema.columns
+                            WHERE table_name = t AND column_name = 'created_at') = 'timestamp without time zone' THEN
+                            EXECUTE format('ALTER TABLE %I ALTER COLUMN created_at TYPE timestamptz USING created_at AT TIME ZONE ''utc'', '
+                                           'ALTER COLUMN created_at SET DEFAULT now()', t);
+                        END IF;
+                    END LOOP;
+                END $$;
+            """)
+
+    # create_all() skips indexes on tables that already exist, so add any missing ones.
+    # Postgres builds them CONCURRENTLY (no write lock on live tables), which can't run
+    # inside a transaction, hence the autocommit connection.
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        concurrently = conn.dialect.name == "postgresql"
+        for table in models.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if concurrently:
+                    index.dialect_options["postgresql"]["concurrently"] = True
+                index.create(bind=conn, checkfirst=True)
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 if os.path.exists(static_dir):
     app.mount("/static", StaticFiles(directory=static_dir), name="static")
@@ -45,6 +114,13 @@ app.add_middleware(
 # Add Middleware (Imported from utils)
 app.middleware("http")(check_admin_access)
 
+# --- SHUTDOWN: close pooled AI clients ---
+@app.on_event("shutdown")
+async def close_ai_clients():
+    await close_groq_client()
+    await ai_new_services.close_clients()
+    log_listener.stop()  # flush queued records
+
 # --- ROUTER REGISTRATION ---
 app.include_router(router)
 
@@ -1,9 +1,23 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Enum, DateTime, Text, JSON, Float, Date
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Enum, DateTime, Text, JSON, Float, Date, Numeric, Index, Uuid, case, and_, cast
+from sqlalchemy.orm import relationship, deferred
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.sql import func
 from db import Base
 import enum
-from datetime import datetime
+import os
+import time
+import uuid
+
+def uuid7() -> uuid.UUID:
+    """
+    Time-ordered UUID (RFC 9562 v7): 48-bit ms timestamp + random bits.
+    New keys land at the right edge of the btree instead of random pages.
+    """
+    value = (time.time_ns() // 1_000_000) << 80 | int.from_bytes(os.urandom(10), "big")
+    value = (value & ~(0xF << 76)) | (0x7 << 76)           # version 7
+    value = (value & ~(0x3 << 62)) | (0x2 << 62)           # RFC 4122 variant
+    return uuid.UUID(int=value)
 
 # ==========================================
 # 1. ENUMS
@@ -89,6 +103,11 @@ class User(Base):
     medical_media = relationship("MedicalMedia", back_populates="patient")
     chat_history = relationship("ChatHistory", back_populates="patient")
     
+    # Reset lookups filter on reset_token; partial index, since almost every row is NULL
+    __table_args__ = (
+        Index("ix_users_reset_token", "reset_token", postgresql_where=reset_token.isnot(None)),
+    )
+
     # NOTE: 'cases' relationship logic is tricky because User can be Patient OR Doctor.
     # We define cases here specifically as "cases where this user is the PATIENT".
     cases = relationship("MedicalCase", back_populates="patient", foreign_keys="MedicalCase.patient_id")
@@ -109,7 +128,9 @@ class PatientProfile(Base):
     date_of_birth = Column(Date, nullable=True)
     gender = Column(Enum(GenderEnum), nullable=True)
     phone = Column(String, nullable=True)
-    address = Column(Text, nullable=True)
+    # Large free-text columns are deferred (group "clinical") so list/grid queries
+    # don't drag them over the wire; load them with undefer_group("clinical").
+    address = deferred(Column(Text, nullable=True), group="clinical")
     
     # Emergency
     emergency_name = Column(String, nullable=True)
@@ -120,11 +141,11 @@ class PatientProfile(Base):
     blood_group = Column(Enum(BloodGroupEnum), nullable=True)
     height_cm = Column(Float, nullable=True)
     weight_kg = Column(Float, nullable=True)
-    allergies = Column(Text, nullable=True)
-    chronic_conditions = Column(Text, nullable=True)
-    current_medications = Column(Text, nullable=True)
-    surgical_history = Column(Text, nullable=True)
-    family_medical_history = Column(Text, nullable=True)
+    allergies = deferred(Column(Text, nullable=True), group="clinical")
+    chronic_conditions = deferred(Column(Text, nullable=True), group="clinical")
+    current_medications = deferred(Column(Text, nullable=True), group="clinical")
+    surgical_history = deferred(Column(Text, nullable=True), group="clinical")
+    family_medical_history = deferred(Column(Text, nullable=True), group="clinical")
 
     # Lifestyle
     lifestyle_status = Column(Enum(LifestyleEnum), default=LifestyleEnum.NONE)
@@ -138,13 +159,23 @@ class PatientProfile(Base):
     user = relationship("User", back_populates="patient_profile")
     sessions = relationship("MedicalSession", back_populates="patient_profile")
 
-    @property
+    @hybrid_property
     def bmi(self):
         if self.height_cm and self.weight_kg:
             height_m = self.height_cm / 100
             return round(self.weight_kg / (height_m * height_m), 2)
         return None
 
+    @bmi.expression
+    def bmi(cls):
+        # SQL form of the same formula, so analytics can filter / ORDER BY bmi server-side
+        height_m = cls.height_cm / 100
+        return case(
+            (and_(cls.height_cm > 0, cls.weight_kg > 0),
+             func.round(cast(cls.weight_kg / (height_m * height_m), Numeric), 2)),
+            else_=None,
+        )
+
 
 class DoctorProfile(Base):
     __tablename__ = "doctor_profiles"
@@ -155,7 +186,7 @@ class DoctorProfile(Base):
     specialty = Column(Enum(MedicalSpecialty), default=MedicalSpecialty.GENERAL)
     is_available = Column(Boolean, default=True)
     active_cases = Column(Integer, default=0)
-    bio = Column(Text, nullable=True)
+    bio = deferred(Column(Text, nullable=True), group="clinical")
     
     user = relationship("User", back_populates="doctor_profile")
     # This relationship matches the "doctor" relationship in MedicalCase
@@ -170,7 +201,7 @@ class MedicalSession(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     patient_profile_id = Column(Integer, ForeignKey("patient_profiles.id"))
-    session_uuid = Column(String, index=True)
+    session_uuid = Column(Uuid, index=True, default=uuid7)  # native 16-byte uuid on Postgres
     
     chief_complaint = Column(Text, nullable=True)
     symptom_onset = Column(String, nullable=True)
@@ -186,6 +217,11 @@ class MedicalSession(Base):
     
     patient_profile = relationship("PatientProfile", back_populates="sessions")
 
+    # Per-patient session timeline, already in created_at order
+    __table_args__ = (
+        Index("ix_sessions_patient_created", "patient_profile_id", "created_at"),
+    )
+
 
 class MedicalCase(Base):
     __tablename__ = "medical_cases"
@@ -203,14 +239,22 @@ class MedicalCase(Base):
     
     status = Column(Enum(CaseStatus), default=CaseStatus.TRIAGE)
     priority_score = Column(Integer, default=0)
-    ai_summary = Column(Text, nullable=True)
+    ai_summary = deferred(Column(Text, nullable=True))  # large; load with undefer()
     
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
     closed_at = Column(DateTime, nullable=True)
 
-    # Relationships
-    patient = relationship("User", foreign_keys=[patient_id], back_populates="cases")
-    doctor = relationship("DoctorProfile", back_populates="assigned_cases")
+    # Relationships (many-to-one: case lists batch these in one IN-query each instead of N)
+    patient = relationship("User", foreign_keys=[patient_id], back_populates="cases", lazy="selectin")
+    doctor = relationship("DoctorProfile", back_populates="assigned_cases", lazy="selectin")
+    # Lazy on purpose: the transcript JSON is large; use selectinload() where it's displayed
+    chat_history = relationship("ChatHistory", foreign_keys=[chat_history_id])
+
+    # Patient timeline + status queues (newest first)
+    __table_args__ = (
+        Index("ix_cases_patient_created", "patient_id", "created_at"),
+        Index("ix_cases_status_created", "status", "created_at"),
+    )
 
 
 class ChatHistory(Base):
@@ -219,11 +263,19 @@ class ChatHistory(Base):
     id = Column(Integer, primary_key=True, index=True)
     patient_id = Column(Integer, ForeignKey("users.id"))
     session_id = Column(String, index=True, unique=True)
-    messages = Column(JSON) 
-    created_at = Column(DateTime, default=datetime.utcnow)
+    messages = Column(JSON().with_variant(JSONB, "postgresql"))  # jsonb: stored pre-parsed, GIN-indexable
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     patient = relationship("User", back_populates="chat_history")
 
+    # session_id is already unique; this serves per-patient chat listings
+    __table_args__ = (
+        Index("ix_chat_patient_created", "patient_id", "created_at"),
+        Index("ix_chat_patient_session", "patient_id", "session_id"),
+        # Containment search over transcripts, e.g. messages @> '[{"content": "..."}]'
+        Index("ix_chat_messages_gin", "messages", postgresql_using="gin"),
+    )
+
 
 class MedicalMedia(Base):
     __tablename__ = "medical_media"
@@ -233,10 +285,15 @@ class MedicalMedia(Base):
     session_id = Column(String)
     
     file_type = Column(String)
-    drive_file_id = Column(String, nullable=True)
+    drive_file_id = Column(String, nullable=True, index=True)
     file_url = Column(String, nullable=True)
-    transcript = Column(Text, nullable=True)
+    transcript = deferred(Column(Text, nullable=True))  # voice/OCR text can be large; load with undefer()
     
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    patient = relationship("User", back_populates="medical_media")
 
-    patient = relationship("User", back_populates="medical_media")
\ No newline at end of file
+    __table_args__ = (
+        Index("ix_media_patient_created", "patient_id", "created_at"),
+        Index("ix_media_patient_session", "patient_id", "session_id"),
+    )
\ No newline at end of file
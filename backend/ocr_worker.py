@@ -0,0 +1,59 @@
+import os
+
+# ==========================================
+# OCR WORKER PROCESS
+# ==========================================
+# Runs inside the ProcessPoolExecutor owned by ai_new_services.
+# Kept in its own small module so spawned workers only import PaddleOCR,
+# not the LLM clients / embedder of the main AI module.
+
+ocr_engine = None
+
+
+# Quantized PP-OCRv4 "slim" models (int8). Download + extract them next to this file,
+# or point the env vars elsewhere; falls back to the stock FP32 models if absent.
+DET_SLIM_DIR = os.getenv("OCR_DET_MODEL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ch_PP-OCRv4_det_slim_infer"))
+REC_SLIM_DIR = os.getenv("OCR_REC_MODEL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "en_PP-OCRv4_rec_slim_infer"))
+
+
+def init_ocr():
+    """Pool initializer: builds one PaddleOCR instance per worker process."""
+    global ocr_engine
+    # Split the cores between the pool's workers instead of oversubscribing
+    workers = int(os.getenv("OCR_WORKERS", "2"))
+    cpu_threads = max(1, (os.cpu_count() or 2) // workers)
+    os.environ.setdefault("OMP_NUM_THREADS", str(cpu_threads))
+
+    from paddleocr import PaddleOCR
+    engine_args = dict(enable_mkldnn=True, cpu_threads=cpu_threads)
+    if os.path.isdir(DET_SLIM_DIR) and os.path.isdir(REC_SLIM_DIR):
+        engine_args.update(det_model_dir=DET_SLIM_DIR, rec_model_dir=REC_SLIM_DIR, precision="int8")
+    else:
+        print("⚠️ PP-OCRv4 slim models not found. Using default FP32 OCR models.")
+
+    ocr_engine = PaddleOCR(
+        use_angle_cls=True,
+        use_doc_orientation_classify=False,
+        use_doc_unwarping=False,
+        use_textline_orientation=False,
+        lang='en',
+        show_log=False,
+        **engine_args
+    )
+
+
+def run_ocr(source) -> str:
+    """Runs PaddleOCR on a file path or encoded image bytes (inside a worker)."""
+    if ocr_engine is None: return "[OCR Error: engine not initialized]"
+    try:
+        result = ocr_engine.ocr(source, cls=True)
+        extracted_text = []
+        if result and result[0]:
+            for line in result:
+                if line:
+                    for word_info in line:
+                        extracted_text.append(word_info[1][0])
+        full_text = "\n".join(extracted_text)
+        return full_text if full_text.strip() else "[OCR: No readable text found]"
+    except Exception as e:
+        return f"[OCR Error: {str(e)}]"
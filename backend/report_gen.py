@@ -1,165 +1,348 @@
 # ... (Keep existing imports: os, json, time, etc.)
 
 # --- PDF GENERATION IMPORTS ---
+import io
+import re
+import copy
+import asyncio
+import hashlib
+import functools
+import threading
+import orjson
+from concurrent.futures import ProcessPoolExecutor
+from pydantic import BaseModel, Field
 
 
 # ==========================================
 # 3. PDF GENERATOR ENGINE (PROFESSIONAL TEMPLATE)
 # ==========================================
 
+# --- COLORS (built once at import; HexColor parsing is not free per report) ---
+SLATE_COLOR = colors.HexColor('#1e293b')
+BRAND_COLOR = colors.HexColor('#0e7490')
+BODY_COLOR = colors.HexColor('#334155')
+LABEL_COLOR = colors.HexColor('#64748b')
+BORDER_COLOR = colors.HexColor('#e2e8f0')
+LIGHT_BG = colors.HexColor('#f1f5f9')
+
+@functools.lru_cache(maxsize=1)
+def _build_styles():
+    """Builds the report styles once (style construction is pure; reused by every PDF)."""
+    base = getSampleStyleSheet()
+    styles = {}
+
+    # --- CUSTOM STYLES (Heidi/Modern Style) ---
+    # Main Title
+    styles['ReportTitle'] = ParagraphStyle(name='ReportTitle', parent=base['Heading1'], 
+                            fontSize=22, textColor=SLATE_COLOR, 
+                            fontName='Helvetica-Bold', spaceAfter=20)
+    
+    # Section Headers (Blue background strip)
+    styles['SectionHeader'] = ParagraphStyle(name='SectionHeader', parent=base['Normal'], 
+                            fontSize=11, textColor=colors.white, backColor=BRAND_COLOR, 
+                            fontName='Helvetica-Bold', borderPadding=(6, 10, 6, 10), 
+                            spaceBefore=15, spaceAfter=10)
+    
+    # Subsection / Labels
+    styles['SubHeader'] = ParagraphStyle(name='SubHeader', parent=base['Heading3'], 
+                            fontSize=10, textColor=BRAND_COLOR, 
+                            fontName='Helvetica-Bold', spaceAfter=4)
+    
+    # Data/Body Text (plain dict, so no clash with the sample sheet's own 'BodyText')
+    styles['BodyText'] = ParagraphStyle(name='ReportBodyText', parent=base['Normal'], 
+                            fontSize=10, leading=14, textColor=BODY_COLOR)
+    
+    # Small Labels for tables
+    styles['Label'] = ParagraphStyle(name='Label', parent=base['Normal'], 
+                            fontSize=8, textColor=LABEL_COLOR)
+
+    # Disclaimer footer
+    styles['Footer'] = ParagraphStyle(name='Footer', parent=base['Normal'], fontSize=7, 
+                            textColor=colors.gray, alignment=TA_CENTER)
+    return styles
+
+
+# Output dir resolved + created once at import; per-call paths are a plain concat
+os.makedirs(REPORTS_DIR, exist_ok=True)
+_REPORTS_PREFIX = os.path.join(os.path.abspath(REPORTS_DIR), '')
+
+# Fixed text that appears in every report: (text, style) parsed into Paragraphs once
+_STATIC_TEXT = {
+    'PATIENT_NAME':   ("PATIENT NAME", 'Label'),
+    'REPORT_DATE':    ("DATE OF REPORT", 'Label'),
+    'PROVIDER':       ("DOCTOR / PROVIDER", 'Label'),
+    'REPORT_ID':      ("REPORT ID", 'Label'),
+    'PROVIDER_NAME':  ("Dr. AI Assistant (MD, FRACGP)", 'BodyText'),
+    'SUBJECTIVE':     ("SUBJECTIVE FINDINGS", 'SectionHeader'),
+    'COMPLAINT':      ("Presenting Complaint", 'SubHeader'),
+    'HISTORY':        ("History & Context", 'SubHeader'),
+    'OBJECTIVE':      ("OBJECTIVE FINDINGS & ASSESSMENT", 'SectionHeader'),
+    'ASSESSMENT':     ("CLINICAL ASSESSMENT / DIAGNOSIS", 'SubHeader'),
+    'PLAN':           ("MANAGEMENT PLAN", 'SectionHeader'),
+    'MEDICATIONS':    ("Rx / Medications", 'SubHeader'),
+    'NEXT_STEPS':     ("Recommendations & Next Steps", 'SubHeader'),
+    'SIGNED_BY':      ("Electronically Signed By:", 'Label'),
+    'DATE_SIGNED':    ("Date Signed:", 'Label'),
+    'SIGNATURE':      ("<b>Dr. AI Assistant</b><br/>Meditab Medical Center", 'BodyText'),
+    'DISCLAIMER':     ("This report is generated by Meditab AI based on provided session data. It does not replace professional medical advice. Please verify all information with primary clinical records.", 'Footer'),
+}
+
+@functools.lru_cache(maxsize=1)
+def _build_static_paragraphs():
+    styles = _build_styles()
+    return {key: Paragraph(text, styles[style]) for key, (text, style) in _STATIC_TEXT.items()}
+
+def _static(key):
+    """Helper: shallow copy of a pre-parsed static Paragraph (wrap/layout state stays per copy)."""
+    return copy.copy(_build_static_paragraphs()[key])
+
+# One medication per comma-separated item; matched lazily (no intermediate list)
+_MED_ITEM = re.compile(r'[^,]+')
+
+def _iter_medications(meds):
+    """Helper: yields cleaned medication names from a raw comma string or a list."""
+    if isinstance(meds, str):
+        return (m for m in (match.group().strip() for match in _MED_ITEM.finditer(meds)) if m)
+    return iter(meds)
+
+# Static page chrome: drawn straight onto the canvas (no Paragraph wrap/layout pass)
+HEADER_HEIGHT = 44  # space reserved in the flow for the brand block
+
+# Table styles (fixed shape, no per-report data)
+# Shared read-only by every Table: setStyle() copies the commands into the table,
+# so never .add() to these at render time.
+TS_ADMIN = TableStyle([
+    ('VALIGN', (0,0), (-1,-1), 'TOP'),
+    ('LINEBELOW', (0,1), (-1,1), 1, BORDER_COLOR), # Line after first data row
+    ('LINEBELOW', (0,3), (-1,3), 1, BORDER_COLOR), # Line after second data row
+    ('BOTTOMPADDING', (0,0), (-1,-1), 12),
+    ('TOPPADDING', (0,0), (-1,-1), 12),
+])
+TS_OBJECTIVE = TableStyle([
+    ('BACKGROUND', (0,0), (-1,0), LIGHT_BG), # Light gray header
+    ('GRID', (0,0), (-1,-1), 0.5, BORDER_COLOR),
+    ('PADDING', (0,0), (-1,-1), 12),
+])
+TS_SIGNATURE = TableStyle([
+    ('LINEABOVE', (0,0), (-1,0), 2, BRAND_COLOR), # Thick blue line above
+    ('VALIGN', (0,0), (-1,-1), 'TOP'),
+    ('TOPPADDING', (0,0), (-1,-1), 15),
+])
+
+
+def _draw_brand_header(canv, doc):
+    """Page callback: MEDITAB brand block at the top of the first page."""
+    top = doc.pagesize[1] - doc.topMargin
+    canv.saveState()
+    canv.setFillColor(BRAND_COLOR)
+    canv.setFont('Helvetica-Bold', 14)
+    canv.drawString(doc.leftMargin, top - 12, "MEDITAB")
+    canv.setFillColor(LABEL_COLOR)
+    canv.setFont('Helvetica', 8)
+    canv.drawString(doc.leftMargin, top - 22, "Secure Health Portal Report")
+    canv.restoreState()
+
+
 class MedicalReportGenerator:
     @staticmethod
     def create_pdf(filename: str, data: dict):
-        file_path = os.path.join(REPORTS_DIR, filename)
-        doc = SimpleDocTemplate(file_path, pagesize=A4, 
+        file_path = _REPORTS_PREFIX + filename
+        buf = io.BytesIO()
+        doc = SimpleDocTemplate(buf, pagesize=A4, 
                                 rightMargin=40, leftMargin=40, 
                                 topMargin=40, bottomMargin=40)
         
-        styles = getSampleStyleSheet()
-        
-        # --- CUSTOM STYLES (Heidi/Modern Style) ---
-        # Main Title
-        styles.add(ParagraphStyle(name='ReportTitle', parent=styles['Heading1'], 
-                                fontSize=22, textColor=colors.HexColor('#1e293b'), 
-                                fontName='Helvetica-Bold', spaceAfter=20))
-        
-        # Section Headers (Blue background strip)
-        styles.add(ParagraphStyle(name='SectionHeader', parent=styles['Normal'], 
-                                fontSize=11, textColor=colors.white, backColor=colors.HexColor('#0e7490'), 
-                                fontName='Helvetica-Bold', borderPadding=(6, 10, 6, 10), 
-                                spaceBefore=15, spaceAfter=10))
-        
-        # Subsection / Labels
-        styles.add(ParagraphStyle(name='SubHeader', parent=styles['Heading3'], 
-                                fontSize=10, textColor=colors.HexColor('#0e7490'), 
-                                fontName='Helvetica-Bold', spaceAfter=4))
-        
-        # Data/Body Text
-        styles.add(ParagraphStyle(name='BodyText', parent=styles['Normal'], 
-                                fontSize=10, leading=14, textColor=colors.HexColor('#334155')))
-        
-        # Small Labels for tables
-        styles.add(ParagraphStyle(name='Label', parent=styles['Normal'], 
-                                fontSize=8, textColor=colors.HexColor('#64748b')))
-        
-        story = []
+        styles = _build_styles()
+        req_date = datetime.now().strftime("%d/%m/%Y")
+
+        # Sections are generators; the story is built up front as a plain list
+        G = MedicalReportGenerator
+        story = [
+            *G._emit_header(data, styles, req_date),
+            *G._emit_subjective(data, styles),
+            *G._emit_objective(data, styles),
+            *G._emit_plan(data, styles),
+            *G._emit_signature(styles, req_date),
+        ]
+        doc.build(story, onFirstPage=_draw_brand_header)
 
+        # One write of the finished bytes, published atomically (readers never see a partial PDF)
+        tmp_path = f"{file_path}.{time.time_ns()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(buf.getbuffer())
+        os.replace(tmp_path, file_path)
+        return file_path
+
+    @staticmethod
+    def _emit_header(data, styles, req_date):
         # --- 1. HEADER & LOGO AREA ---
-        # (Text based logo for now, can be replaced with Image)
-        story.append(Paragraph("MEDITAB", ParagraphStyle(name='Brand', parent=styles['Normal'], fontSize=14, textColor=colors.HexColor('#0e7490'), fontName='Helvetica-Bold')))
-        story.append(Paragraph("Secure Health Portal Report", styles['Label']))
-        story.append(Spacer(1, 20))
+        # (Text based logo drawn by _draw_brand_header; can be replaced with Image)
+        yield Spacer(1, HEADER_HEIGHT)
 
-        story.append(Paragraph(f"MEDICAL REPORT: {data.get('patient_name', 'Unknown').upper()}", styles['ReportTitle']))
+        yield Paragraph(f"MEDICAL REPORT: {data.get('patient_name', 'Unknown').upper()}", styles['ReportTitle'])
 
         # --- 2. ADMINISTRATIVE DETAILS (Grid) ---
-        req_date = datetime.now().strftime("%d/%m/%Y")
-        
         # Row 1: Patient Name | DOB
         # Row 2: Date | Ref ID
         admin_data = [
-            [Paragraph("PATIENT NAME", styles['Label']), Paragraph("DATE OF REPORT", styles['Label'])],
+            [_static('PATIENT_NAME'), _static('REPORT_DATE')],
             [Paragraph(data.get('patient_name', 'Unknown'), styles['BodyText']), Paragraph(req_date, styles['BodyText'])],
             
-            [Paragraph("DOCTOR / PROVIDER", styles['Label']), Paragraph("REPORT ID", styles['Label'])],
-            [Paragraph("Dr. AI Assistant (MD, FRACGP)", styles['BodyText']), Paragraph(str(int(time.time()))[-6:], styles['BodyText'])]
+            [_static('PROVIDER'), _static('REPORT_ID')],
+            [_static('PROVIDER_NAME'), Paragraph(data.get('report_id') or format(time.time_ns() // 1_000_000 & 0xFFFFFFFF, 'x'), styles['BodyText'])]
         ]
         
         admin_table = Table(admin_data, colWidths=[3.5*inch, 3.5*inch])
-        admin_table.setStyle(TableStyle([
-            ('VALIGN', (0,0), (-1,-1), 'TOP'),
-            ('LINEBELOW', (0,1), (-1,1), 1, colors.HexColor('#e2e8f0')), # Line after first data row
-            ('LINEBELOW', (0,3), (-1,3), 1, colors.HexColor('#e2e8f0')), # Line after second data row
-            ('BOTTOMPADDING', (0,0), (-1,-1), 12),
-            ('TOPPADDING', (0,0), (-1,-1), 12),
-        ]))
-        story.append(admin_table)
-        story.append(Spacer(1, 10))
+        admin_table.setStyle(TS_ADMIN)
+        yield admin_table
+        yield Spacer(1, 10)
 
+    @staticmethod
+    def _emit_subjective(data, styles):
         # --- 3. SUBJECTIVE FINDINGS ---
-        story.append(Paragraph("SUBJECTIVE FINDINGS", styles['SectionHeader']))
+        yield _static('SUBJECTIVE')
         
-        story.append(Paragraph("Presenting Complaint", styles['SubHeader']))
-        story.append(Paragraph(data.get("chief_complaint", "N/A"), styles['BodyText']))
-        story.append(Spacer(1, 8))
+        yield _static('COMPLAINT')
+        yield Paragraph(data.get("chief_complaint", "N/A"), styles['BodyText'])
+        yield Spacer(1, 8)
         
-        story.append(Paragraph("History & Context", styles['SubHeader']))
-        story.append(Paragraph(data.get("history", "N/A"), styles['BodyText']))
-        story.append(Spacer(1, 15))
+        yield _static('HISTORY')
+        yield Paragraph(data.get("history", "N/A"), styles['BodyText'])
+        yield Spacer(1, 15)
 
+    @staticmethod
+    def _emit_objective(data, styles):
         # --- 4. OBJECTIVE FINDINGS (Table Style) ---
-        story.append(Paragraph("OBJECTIVE FINDINGS & ASSESSMENT", styles['SectionHeader']))
+        yield _static('OBJECTIVE')
         
         # Table Header
-        obj_data = [[Paragraph("CLINICAL ASSESSMENT / DIAGNOSIS", styles['SubHeader'])]]
+        obj_data = [[_static('ASSESSMENT')]]
         # Table Content
         obj_data.append([Paragraph(data.get("diagnosis", "Pending Review"), styles['BodyText'])])
         
         obj_table = Table(obj_data, colWidths=[7*inch])
-        obj_table.setStyle(TableStyle([
-            ('BACKGROUND', (0,0), (-1,0), colors.HexColor('#f1f5f9')), # Light gray header
-            ('GRID', (0,0), (-1,-1), 0.5, colors.HexColor('#e2e8f0')),
-            ('PADDING', (0,0), (-1,-1), 12),
-        ]))
-        story.append(obj_table)
-        story.append(Spacer(1, 15))
+        obj_table.setStyle(TS_OBJECTIVE)
+        yield obj_table
+        yield Spacer(1, 15)
 
+    @staticmethod
+    def _emit_plan(data, styles):
         # --- 5. MANAGEMENT PLAN ---
-        story.append(Paragraph("MANAGEMENT PLAN", styles['SectionHeader']))
+        yield _static('PLAN')
         
         # Medications
         if data.get("medications"):
-            story.append(Paragraph("Rx / Medications", styles['SubHeader']))
-            for med in data['medications']:
-                story.append(Paragraph(f"• {med}", styles['BodyText']))
-            story.append(Spacer(1, 8))
+            yield _static('MEDICATIONS')
+            for med in _iter_medications(data['medications']):
+                yield Paragraph(f"• {med}", styles['BodyText'])
+            yield Spacer(1, 8)
 
         # Recommendations/Plan
-        story.append(Paragraph("Recommendations & Next Steps", styles['SubHeader']))
-        story.append(Paragraph(data.get("recommendations", "Follow up as required."), styles['BodyText']))
-        story.append(Spacer(1, 30))
+        yield _static('NEXT_STEPS')
+        yield Paragraph(data.get("recommendations", "Follow up as required."), styles['BodyText'])
+        yield Spacer(1, 30)
 
+    @staticmethod
+    def _emit_signature(styles, req_date):
         # --- 6. SIGNATURE BLOCK ---
         sig_data = [
-            [Paragraph("Electronically Signed By:", styles['Label']), Paragraph("Date Signed:", styles['Label'])],
-            [Paragraph("<b>Dr. AI Assistant</b><br/>Meditab Medical Center", styles['BodyText']), Paragraph(req_date, styles['BodyText'])]
+            [_static('SIGNED_BY'), _static('DATE_SIGNED')],
+            [_static('SIGNATURE'), Paragraph(req_date, styles['BodyText'])]
         ]
         sig_table = Table(sig_data, colWidths=[4*inch, 3*inch])
-        sig_table.setStyle(TableStyle([
-            ('LINEABOVE', (0,0), (-1,0), 2, colors.HexColor('#0e7490')), # Thick blue line above
-            ('VALIGN', (0,0), (-1,-1), 'TOP'),
-            ('TOPPADDING', (0,0), (-1,-1), 15),
-        ]))
-        story.append(sig_table)
+        sig_table.setStyle(TS_SIGNATURE)
+        yield sig_table
         
         # --- 7. DISCLAIMER FOOTER ---
-        story.append(Spacer(1, 40))
-        disclaimer = "This report is generated by Meditab AI based on provided session data. It does not replace professional medical advice. Please verify all information with primary clinical records."
-        story.append(Paragraph(disclaimer, ParagraphStyle(name='Footer', parent=styles['Normal'], fontSize=7, textColor=colors.gray, alignment=TA_CENTER)))
+        yield Spacer(1, 40)
+        yield _static('DISCLAIMER')
 
-        doc.build(story)
-        return file_path
+@functools.lru_cache(maxsize=256)
+def _report_cached(filename: str) -> bool:
+    """Helper: remembers reports already on disk (only positive results are kept)."""
+    if not os.path.exists(_REPORTS_PREFIX + filename):
+        raise FileNotFoundError(filename)  # exceptions aren't cached by lru_cache
+    return True
 
-@tool
-def generate_hospital_pdf(patient_name: str, chief_complaint: str, history: str, diagnosis: str, medications: str, recommendations: str):
+def _report_exists(filename: str) -> bool:
+    try: return _report_cached(filename)
+    except FileNotFoundError: return False
+
+def _assign_report_name(data: dict) -> str:
+    """
+    Helper: content-addressed filename for a report payload (sets data['report_id']).
+    Identical (re-)requests on the same day map to the same file.
+    """
+    key = hashlib.blake2b(
+        orjson.dumps({**data, "_date": datetime.now().strftime("%Y-%m-%d")}, option=orjson.OPT_SORT_KEYS),
+        digest_size=8
+    ).hexdigest()
+    data["report_id"] = key  # same ID on disk and printed in the PDF
+    return f"Report_{key}.pdf"
+
+# --- BULK GENERATION (process pool) ---
+# ReportLab layout is pure-Python and holds the GIL, so batches scale across processes.
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", str(os.cpu_count() or 2)))
+_report_pool = None
+_report_pool_lock = threading.Lock()
+
+def _get_report_pool() -> ProcessPoolExecutor:
+    global _report_pool
+    with _report_pool_lock:
+        if _report_pool is None:
+            # Each worker builds the style dict once, up front
+            _report_pool = ProcessPoolExecutor(max_workers=REPORT_WORKERS, initializer=_build_styles)
+        return _report_pool
+
+def generate_many(datas: list) -> list:
+    """
+    Renders many reports in parallel (e.g. monthly batches).
+    Returns the /static/reports/ URL for each payload, in order; cached ones are not re-rendered.
+    """
+    filenames = [_assign_report_name(data) for data in datas]
+    todo = [(name, data) for name, data in zip(filenames, datas) if not _report_exists(name)]
+    if todo:
+        names, payloads = zip(*todo)
+        list(_get_report_pool().map(MedicalReportGenerator.create_pdf, names, payloads))
+    return [f"/static/reports/{name}" for name in filenames]
+
+async def generate_many_async(datas: list) -> list:
+    """Async entry point (route / BackgroundTasks): waits on the pool off the event loop."""
+    return await asyncio.to_thread(generate_many, datas)
+
+# Explicit schema: the tool's JSON schema is fixed here instead of being
+# inferred from the function signature/docstring by LangChain
+class ReportArgs(BaseModel):
+    patient_name: str = Field(description="Patient's full name")
+    chief_complaint: str = Field(description="Main reason for the visit")
+    history: str = Field(description="History of present illness")
+    diagnosis: str = Field(description="Clinical assessment / diagnosis")
+    medications: str = Field(description="Comma-separated list of medications")
+    recommendations: str = Field(description="Management plan and next steps")
+
+@tool("generate_hospital_pdf", args_schema=ReportArgs)
+async def generate_hospital_pdf(patient_name: str, chief_complaint: str, history: str, diagnosis: str, medications: str, recommendations: str):
     """
     Generates a formal PDF medical report. 
     Use this tool ONLY when the user asks for a summary, final report, or discharge paper.
     medications input should be a comma-separated string.
     """
-    filename = f"Report_{int(time.time())}.pdf"
-    med_list = [m.strip() for m in medications.split(',')]
-    
     data = {
         "patient_name": patient_name,
         "chief_complaint": chief_complaint,
         "history": history,
         "diagnosis": diagnosis,
-        "medications": med_list,
+        "medications": medications,  # raw comma string, split lazily while rendering
         "recommendations": recommendations
     }
     
-    path = MedicalReportGenerator.create_pdf(filename, data)
+    # Content-addressed filename: identical (re-)requests on the same day reuse the file
+    filename = _assign_report_name(data)
+    if _report_exists(filename):
+        return f"REPORT_GENERATED_AT: /static/reports/{filename}"
+
+    # ReportLab layout + file write are blocking: render in a worker thread
+    await asyncio.to_thread(MedicalReportGenerator.create_pdf, filename, data)
     return f"REPORT_GENERATED_AT: /static/reports/{filename}"
 
 model_with_tools = llm.bind_tools([generate_hospital_pdf])
@@ -1,22 +1,36 @@
 from fastapi import (
     APIRouter,
+    BackgroundTasks,
     Depends,
     HTTPException,
     Request,
     UploadFile,
     File,
     Form,
+    Query,
     Response,
 )
-from fastapi.responses import HTMLResponse
-from sqlalchemy.orm import Session
-from sqlalchemy.orm.attributes import flag_modified
-from typing import List
+from fastapi.responses import HTMLResponse, StreamingResponse, ORJSONResponse
+from sqlalchemy import select, update, delete, and_, cast, func
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload, load_only, undefer, undefer_group
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import flag_modified, set_committed_value
+from typing import List, Optional
 import os
+import anyio
+import asyncio
+import logging
+import aiofiles
 import secrets
+import hashlib
+import threading
+import time
 from datetime import datetime
 from datetime import timedelta
 from starlette.responses import RedirectResponse
+from cachetools import LRUCache, TTLCache
 from google.oauth2 import id_token
 from google.auth.transport import requests as google_requests
 from dotenv import load_dotenv
@@ -25,10 +39,11 @@ import string
 # Local Imports
 import models
 import schemas
-from db import SessionLocal
-from ai_new_services import get_ai_response, transcribe_audio, generate_chat_title, analyze_document, get_text_suggestions
+from db import SessionLocal, AsyncSessionLocal
+from ai_new_services import get_ai_response, stream_ai_response, transcribe_audio, generate_chat_title, analyze_document, get_text_suggestions
 from utils import (
     get_db,
+    get_async_db,
     is_system_message,
     sanitize_message_content,
     drive_service,
@@ -36,19 +51,68 @@ from utils import (
     generate_user_hash,
     is_email_allowed,
     finalize_login,
+    set_login_cookies,
+    redirect_for,
     send_otp_email,
     send_reset_link,
     verify_access,
     verify_route_access,
     get_current_user_from_cookie,
-    create_stable_hash
+    create_stable_hash,
+    hit_rate_limit,
+    client_ip,
+    hash_password,
+    verify_password,
+    password_needs_rehash,
+    get_profile_percent,
+    set_profile_percent,
+    clear_profile_percent,
+    invalidate_cookie_user
 )
 
 load_dotenv()
 router = APIRouter()
+logger = logging.getLogger(__name__)
 GOOGLE_CLIENT_ID = os.getenv('gauth_client_id')
 RESTRICT_SIGNUP = False
 
+# User + both profiles (full clinical columns) in one joined SELECT
+PROFILE_LOAD = (
+    joinedload(models.User.patient_profile).undefer_group("clinical"),
+    joinedload(models.User.doctor_profile).undefer_group("clinical"),
+)
+
+# Rate limits: (max hits, window seconds)
+RESET_LIMIT_EMAIL = (3, 3600)
+RESET_LIMIT_IP = (10, 900)
+LOGIN_LIMIT_EMAIL = (10, 900)
+LOGIN_LIMIT_IP = (30, 900)
+
+def _email_key(email) -> str:
+    return hashlib.sha256(str(email).strip().lower().encode()).hexdigest()
+
+# --- GOOGLE TOKEN CACHE ---
+# sha256(credential) -> (idinfo, exp). A repeated One-Tap login with the same
+# credential skips the cert fetch + RSA check until the token itself expires.
+_google_token_cache = LRUCache(maxsize=1024)
+_google_token_lock = threading.Lock()
+_google_transport = google_requests.Request()  # one pooled HTTP session for cert fetches
+
+def _verify_google_token(credential: str) -> dict:
+    """Helper: verify_oauth2_token, cached until the token's own 'exp'."""
+    key = hashlib.sha256(credential.encode()).hexdigest()
+    with _google_token_lock:
+        hit = _google_token_cache.get(key)
+        if hit is not None:
+            if time.time() < hit[1]:
+                return hit[0]
+            del _google_token_cache[key]  # expired: evict lazily
+
+    idinfo = id_token.verify_oauth2_token(credential, _google_transport, GOOGLE_CLIENT_ID)
+    with _google_token_lock:
+        _google_token_cache[key] = (idinfo, float(idinfo['exp']))
+    return idinfo
+
 # --- SECURITY HELPER (Internal Use) ---
 def verify_access(
     request: Request, allowed_roles: list, required_hash: str = None
@@ -69,7 +133,7 @@ def verify_access(
         return False
 
     if required_hash:
-        if current_hash != required_hash:
+        if not secrets.compare_digest((current_hash or "").encode(), required_hash.encode()):
             return False 
 
     return True
@@ -77,17 +141,14 @@ def verify_access(
 # --- HTML ROUTES ---
 
 @router.post("/auth/google-one-tap")
-def google_one_tap_login(
+async def google_one_tap_login(
     response: Response,
     login_data: schemas.GoogleOneTapInput,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
-        idinfo = id_token.verify_oauth2_token(
-            login_data.credential, 
-            google_requests.Request(), 
-            GOOGLE_CLIENT_ID
-        )
+        # Cache misses fetch Google's certs over HTTP: keep that off the event loop
+        idinfo = await asyncio.to_thread(_verify_google_token, login_data.credential)
         email = idinfo.get('email')
         name = idinfo.get('name')
         google_sub = idinfo.get('sub')
@@ -98,7 +159,7 @@ def google_one_tap_login(
         if RESTRICT_SIGNUP and not is_email_allowed(email):
              return {"success": False, "message": "Access restricted"}
 
-        user = db.query(models.User).filter(models.User.email == email).first()
+        user = (await db.execute(select(models.User).where(models.User.email == email))).scalar_one_or_none()
 
         if not user:
             user = models.User(
@@ -110,30 +171,25 @@ def google_one_tap_login(
                 has_signed_baa=True
             )
             db.add(user)
-            db.commit()
-            db.refresh(user)
+            try:
+                await db.flush()
 
-            new_profile = models.PatientProfile(
-                user_id=user.id,
-                full_name=name,
-                lifestyle_status=models.LifestyleEnum.NONE,
-                is_profile_complete=False
-            )
-            db.add(new_profile)
-            db.commit()
+                new_profile = models.PatientProfile(
+                    user_id=user.id,
+                    full_name=name,
+                    lifestyle_status=models.LifestyleEnum.NONE,
+                    is_profile_complete=False
+                )
+                db.add(new_profile)
+                await db.commit()
+            except IntegrityError:
+                # Concurrent One-Tap for the same email created the row first: use it
+                await db.rollback()
+                user = (await db.execute(select(models.User).where(models.User.email == email))).scalar_one()
 
-        user_hash = create_stable_hash(user.email)
-        
         # SET COOKIES (Including user_id for secure lookups)
-        response.set_cookie(key="user_role", value=user.role.value.upper(), httponly=True)
-        response.set_cookie(key="user_hash", value=user_hash, httponly=True)
-        response.set_cookie(key="user_id", value=str(user.id), httponly=True) # Critical for security
-
-        redirect_url = "/dashboard"
-        if user.role == models.UserRole.PATIENT:
-            redirect_url = f"/app/{user_hash}"
-        elif user.role == models.UserRole.DOCTOR:
-            redirect_url = f"/doctor-app/{user_hash}"
+        user_hash = set_login_cookies(user, response)
+        redirect_url = redirect_for(user.role, user_hash)
 
         return {
             "success": True,
@@ -153,35 +209,47 @@ def google_one_tap_login(
     except ValueError:
         return {"success": False, "message": "Invalid Token"}
     except Exception as e:
-        print(f"Auth Error: {e}")
+        logger.exception("Auth Error")
         return {"success": False, "message": "Authentication failed"}
 
+# --- STATIC PAGES ---
+# These templates only vary with the year: render once per (page, year) and reuse the HTML.
+# Links never come from the client's Host header: url_for is built from PUBLIC_BASE_URL
+# (e.g. "https://portal.example.com"), or root-relative when it isn't set.
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
+STATIC_PAGE_HEADERS = {"Cache-Control": "public, max-age=3600"}
+_static_pages = LRUCache(maxsize=64)
+
+def _static_page(request: Request, name: str, **context) -> HTMLResponse:
+    """Helper: cached render of a request-independent template (context must be constant)."""
+    year = datetime.now().year
+    key = (name, year)
+    html = _static_pages.get(key)
+    if html is None:
+        def url_for(route_name: str, **params) -> str:
+            return PUBLIC_BASE_URL + str(request.app.url_path_for(route_name, **params))
+        html = templates.get_template(name).render(url_for=url_for, current_year=year, **context)
+        _static_pages[key] = html
+    return HTMLResponse(html, headers=STATIC_PAGE_HEADERS)
+
 @router.get("/", response_class=HTMLResponse)
 async def serve_landing(request: Request):
-    return templates.TemplateResponse("website/landing_page.html", {"request": request,"client_id": GOOGLE_CLIENT_ID})
+    return _static_page(request, "website/landing_page.html", client_id=GOOGLE_CLIENT_ID)
 
 
 @router.get("/access-denied", response_class=HTMLResponse)
 async def access_denied(request: Request):
-    return templates.TemplateResponse("website/403.html", {"request": request})
+    return _static_page(request, "website/403.html")
 
 @router.get("/legal/terms", response_class=HTMLResponse)
 async def serve_terms(request: Request):
     """Serves the Terms of Service page."""
-    return templates.TemplateResponse("legal/terms.html", {
-        "request": request,
-        "current_year": datetime.now().year,
-        "company_name": "Meditab Portal"
-    })
+    return _static_page(request, "legal/terms.html", company_name="Meditab Portal")
 
 @router.get("/legal/privacy-baa", response_class=HTMLResponse)
 async def serve_privacy_baa(request: Request):
     """Serves the combined BAA and Privacy Policy page."""
-    return templates.TemplateResponse("legal/privacy_baa.html", {
-        "request": request, 
-        "current_year": datetime.now().year,
-        "company_name": "Meditab Portal"
-    })
+    return _static_page(request, "legal/privacy_baa.html", company_name="Meditab Portal")
 
 # --- PASSWORD RESET ROUTES ---
 
@@ -189,14 +257,25 @@ async def serve_privacy_baa(request: Request):
 async def forgot_password(
     request: Request, # Need request to get base URL
     data: dict, 
-    db: Session = Depends(get_db)
+    background: BackgroundTasks,
+    db: AsyncSession = Depends(get_async_db)
 ):
     email = data.get("email")
-    user = db.query(models.User).filter(models.User.email == email).first()
+    generic = {"status": "success", "message": "If that email exists, a link has been sent."}
+
+    # Throttle before any DB write / SMTP call; same generic reply so limits don't leak which emails exist
+    throttled = await asyncio.gather(
+        hit_rate_limit(f"pwreset:e:{_email_key(email)}", *RESET_LIMIT_EMAIL),
+        hit_rate_limit(f"pwreset:ip:{client_ip(request)}", *RESET_LIMIT_IP),
+    )
+    if any(throttled):
+        return generic
+
+    user = (await db.execute(select(models.User).where(models.User.email == email))).scalar_one_or_none()
 
     # Security: Always return "success" even if email doesn't exist (prevents user enumeration)
     if not user:
-        return {"status": "success", "message": "If that email exists, a link has been sent."}
+        return generic
 
     # 1. Generate Token (UUID)
     token = secrets.token_urlsafe(32)
@@ -204,15 +283,15 @@ async def forgot_password(
     # 2. Save to DB (15 min expiry)
     user.reset_token = token
     user.reset_token_expiry = datetime.utcnow() + timedelta(minutes=15)
-    db.commit()
+    await db.commit()
 
     # 3. Construct Link
     # Result looks like: http://127.0.0.1:8000/?action=reset_password&token=xyz...
     base_url = str(request.base_url).rstrip("/")
     reset_link = f"{base_url}/?action=reset_password&token={token}"
 
-    # 4. Send Email
-    send_reset_link(user.email, reset_link)
+    # 4. Send Email (after the reply; sync task -> runs in the threadpool)
+    background.add_task(send_reset_link, user.email, reset_link)
 
     return {"status": "success", "message": "Reset link sent to your email."}
 
@@ -221,6 +300,10 @@ def reset_password_finish(data: dict, db: Session = Depends(get_db)):
     token = data.get("token")
     new_password = data.get("password")
 
+    # Reject before the lookup: a missing token would match "reset_token IS NULL"
+    if not isinstance(token, str) or not token or not isinstance(new_password, str) or not new_password:
+        raise HTTPException(status_code=400, detail="Token and new password are required.")
+
     # 1. Find User by Token
     user = db.query(models.User).filter(models.User.reset_token == token).first()
 
@@ -232,7 +315,7 @@ def reset_password_finish(data: dict, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail="Link has expired. Please request a new one.")
 
     # 3. Update Password
-    user.hashed_password = new_password  # Ensure you hash this if using hashing lib!
+    user.hashed_password = hash_password(new_password)  # sync route: already on a worker thread
     
     # 4. Clear Token (Security: Prevent replay attacks)
     user.reset_token = None
@@ -243,6 +326,21 @@ def reset_password_finish(data: dict, db: Session = Depends(get_db)):
 
 # --- FILE UPLOAD ROUTE ---
 
+UPLOAD_CHUNK_SIZE = 1 << 16  # 64KB
+
+async def _save_upload(file: UploadFile, path: str, keep: bool = False) -> Optional[bytes]:
+    """
+    Helper: streams an upload to disk in chunks (no blocking writes).
+    keep=True also returns the bytes from the same pass, for analyzers that would
+    otherwise read the file straight back (the disk copy is still needed for Drive).
+    """
+    chunks = [] if keep else None
+    async with aiofiles.open(path, "wb") as buffer:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            await buffer.write(chunk)
+            if keep: chunks.append(chunk)
+    return b"".join(chunks) if keep else None
+
 @router.post("/upload/")
 async def upload_file(
     patient_id: str = Form(...),
@@ -259,32 +357,46 @@ async def upload_file(
     temp_filename = f"temp_{file.filename}"
     
     try:
-        with open(temp_filename, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
-
-        # 1. DOCUMENT ANALYSIS (The "Read" Logic)
-        analysis_result = None
-        if file.content_type in ["application/pdf", "image/jpeg", "image/png", "image/jpg"]:
-            print(f"Analyzing {file.filename}...")
-            # Calls the Vision Model
-            analysis_result = await analyze_document(temp_filename, file.content_type)
-        
+        analyzable = file.content_type in ["application/pdf", "image/jpeg", "image/png", "image/jpg"]
+        data = await _save_upload(file, temp_filename, keep=analyzable or is_rec)
+
+        # 1-3. Analysis, Transcription and Drive Upload are independent: run them concurrently
+        async def _skip(): return None
+
+        # 1. DOCUMENT ANALYSIS (The "Read" Logic) - Calls the Vision Model
+        t_analysis = _skip()
+        if analyzable:
+            logger.debug("Analyzing %s...", file.filename)
+            t_analysis = analyze_document(temp_filename, file.content_type, data)
+
         # 2. Transcription
-        transcript_text = None
-        if is_rec:
-            transcript_text = await transcribe_audio(temp_filename)
+        t_transcript = transcribe_audio(temp_filename, data) if is_rec else _skip()
 
         # 3. Drive Upload
-        drive_link = None
-        drive_file_id = None
+        t_drive = _skip()
         if drive_service:
-            res = drive_service.upload_to_session_folder(
+            t_drive = drive_service.upload_to_session_folder(
                 user_hash, session_id, temp_filename, file.filename
             )
-            if res: 
-                drive_link = res.get("link")
-                drive_file_id = res.get("id")
+
+        analysis_result, transcript_text, res = await asyncio.gather(
+            t_analysis, t_transcript, t_drive, return_exceptions=True
+        )
+        if isinstance(analysis_result, Exception):
+            logger.error("Analysis Error: %s", analysis_result)
+            analysis_result = None
+        if isinstance(transcript_text, Exception):
+            logger.error("Transcription Error: %s", transcript_text)
+            transcript_text = None
+        if isinstance(res, Exception):
+            logger.error("Drive Upload Error: %s", res)
+            res = None
+
+        drive_link = None
+        drive_file_id = None
+        if res: 
+            drive_link = res.get("link")
+            drive_file_id = res.get("id")
 
         # 4. Save to DB (Store analysis so AI can read it later)
         # We prefer the transcript, then the analysis, then generic text
@@ -314,45 +426,94 @@ async def upload_file(
 
 # --- CHAT & VOICE ROUTES ---
 
+def _clean_messages(messages, now_iso: str) -> list:
+    """Helper: drops system messages and sanitizes the rest in one pass (content read once)."""
+    clean = []
+    for msg in messages or ():
+        content = msg.get("content")
+        if is_system_message(content):
+            continue
+        clean.append({
+            "role": msg.get("role", "user"),
+            "content": sanitize_message_content(content),
+            "timestamp": msg.get("timestamp") or now_iso,
+        })
+    return clean
+
 @router.get("/chat_history/", response_model=List[schemas.ChatHistoryRead])
-def read_chat_history(db: Session = Depends(get_db)):
-    history = db.query(models.ChatHistory).all()
-    for record in history:
-        if record.messages:
-            clean_msgs = []
-            for msg in record.messages:
-                if is_system_message(msg.get("content")):
-                    continue
-                safe_content = sanitize_message_content(msg.get("content"))
-                clean_msgs.append({
-                    "role": msg.get("role", "user"),
-                    "content": safe_content,
-                    "timestamp": msg.get("timestamp", str(datetime.utcnow())),
-                })
-            record.messages = clean_msgs
-    return history
+def read_chat_history(
+    request: Request,
+    limit: int = Query(50, ge=1, le=200),
+    offset: int = Query(0, ge=0),
+    session_id: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    # Only the logged-in patient's sessions, one page at a time (newest first)
+    user = get_current_user_from_cookie(request, db)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not logged in")
+
+    query = db.query(models.ChatHistory).filter(models.ChatHistory.patient_id == user.id)
+    if session_id:
+        query = query.filter(models.ChatHistory.session_id == session_id)
+    history = query.order_by(models.ChatHistory.created_at.desc()).offset(offset).limit(limit).all()
+
+    # Sanitized copies for the response (the ORM rows are left untouched).
+    # Already in ChatHistoryRead shape: hand them straight to orjson instead of
+    # re-validating every message through the response_model.
+    now_iso = datetime.utcnow().isoformat()
+    return ORJSONResponse([
+        {"session_id": record.session_id, "messages": _clean_messages(record.messages, now_iso)}
+        for record in history
+    ])
+
+
+# --- CHAT APPEND HELPER ---
+async def _append_chat(db: AsyncSession, chat_record: models.ChatHistory, new_msgs: list):
+    """
+    Appends a turn to an existing chat record.
+    Postgres: server-side jsonb '||' append, so only the new messages are sent and the
+    history is never re-serialized. Other databases rewrite the whole list.
+    """
+    msgs = chat_record.messages or []
+    if db.bind.dialect.name == "postgresql":
+        await db.execute(
+            update(models.ChatHistory)
+            .where(models.ChatHistory.id == chat_record.id)
+            .values(messages=func.coalesce(models.ChatHistory.messages, cast([], JSONB)).op("||")(cast(new_msgs, JSONB)))
+            .execution_options(synchronize_session=False)
+        )
+        # Mirror the append in memory for the response without marking the column dirty
+        msgs.extend(new_msgs)
+        set_committed_value(chat_record, "messages", msgs)
+    else:
+        chat_record.messages = msgs + new_msgs
+        flag_modified(chat_record, "messages")
+
+
+async def _fetch_user_and_chat(db: AsyncSession, user_id: int, session_id: str):
+    """Helper: (user, chat record) for a chat turn via one outer join; (None, None) if no user."""
+    row = (await db.execute(
+        select(models.User, models.ChatHistory)
+        .outerjoin(models.ChatHistory, and_(
+            models.ChatHistory.patient_id == models.User.id,
+            models.ChatHistory.session_id == session_id,
+        ))
+        .where(models.User.id == user_id)
+    )).first()
+    return tuple(row) if row else (None, None)
 
 
 # --- UPDATED CHAT ROUTE ---
 
 @router.post("/chat/send", response_model=schemas.ChatHistoryRead)
 async def send_chat_message(
-    chat_data: schemas.ChatInput, db: Session = Depends(get_db)
+    chat_data: schemas.ChatInput, db: AsyncSession = Depends(get_async_db)
 ):
-    # 1. Fetch User to determine Role (Doctor vs Patient)
-    user = db.query(models.User).filter(models.User.id == chat_data.user_id).first()
+    # 1+2. Fetch User (Role: Doctor vs Patient) and the session's Chat Record in one round trip
+    user, chat_record = await _fetch_user_and_chat(db, chat_data.user_id, chat_data.session_id)
     user_role = user.role.value.upper() if user else "PATIENT"
 
-    # 2. Fetch or Create Chat Record
-    chat_record = (
-        db.query(models.ChatHistory)
-        .filter(
-            models.ChatHistory.session_id == chat_data.session_id,
-            models.ChatHistory.patient_id == chat_data.user_id,
-        )
-        .first()
-    )
-
     # 3. Prepare History for AI
     raw_history = chat_record.messages if chat_record else []
     history_for_ai = [
@@ -369,7 +530,7 @@ async def send_chat_message(
             user_role=user_role
         )
     except Exception as e:
-        print(f"AI Error: {e}")
+        logger.exception("AI Error")
         ai_text = "I'm having trouble connecting to the medical network right now."
 
     # 5. Construct Messages
@@ -386,11 +547,8 @@ async def send_chat_message(
 
     # 6. Save to DB
     if chat_record:
-        current_messages = list(chat_record.messages)
-        current_messages.append(user_msg)
-        current_messages.append(ai_msg)
-        chat_record.messages = current_messages
-        flag_modified(chat_record, "messages")
+        await _append_chat(db, chat_record, [user_msg, ai_msg])
+        await db.commit()
     else:
         chat_record = models.ChatHistory(
             patient_id=chat_data.user_id,
@@ -398,12 +556,88 @@ async def send_chat_message(
             messages=[user_msg, ai_msg],
         )
         db.add(chat_record)
-
-    db.commit()
-    db.refresh(chat_record)
+        await db.commit()
+        await db.refresh(chat_record)
     return chat_record
 
 
+# --- STREAMING CHAT ROUTE ---
+
+@router.post("/chat/stream")
+async def stream_chat_message(
+    chat_data: schemas.ChatInput, db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Same contract as /chat/send, but the AI reply is streamed as plain text
+    chunks (first token in ~TTFT instead of full generation time).
+    The exchange is saved when the stream ends, including partial replies
+    when the client disconnects early.
+    """
+    # 1. Fetch User (Role: Doctor vs Patient) and the session's Chat Record in one round trip
+    user, chat_record = await _fetch_user_and_chat(db, chat_data.user_id, chat_data.session_id)
+    user_role = user.role.value.upper() if user else "PATIENT"
+
+    # 2. Prepare History for AI
+    raw_history = chat_record.messages if chat_record else []
+    history_for_ai = [
+        {"role": m.get("role"), "content": sanitize_message_content(m.get("content"))}
+        for m in raw_history
+        if not is_system_message(m.get("content"))
+    ]
+    user_msg = {
+        "role": "user",
+        "content": chat_data.message,
+        "timestamp": datetime.utcnow().isoformat(),
+    }
+
+    async def save_turn(ai_text: str):
+        ai_msg = {
+            "role": "assistant",
+            "content": ai_text,
+            "timestamp": datetime.utcnow().isoformat(),
+        }
+
+        # 3. Save to DB (own session: the request-scoped one is closed by now)
+        async with AsyncSessionLocal() as save_db:
+            try:
+                if chat_record:
+                    # Re-attach the row fetched above (no reload), then append server-side
+                    record = await save_db.merge(chat_record, load=False)
+                    await _append_chat(save_db, record, [user_msg, ai_msg])
+                else:
+                    save_db.add(models.ChatHistory(
+                        patient_id=chat_data.user_id,
+                        session_id=chat_data.session_id,
+                        messages=[user_msg, ai_msg],
+                    ))
+                await save_db.commit()
+            except Exception:
+                await save_db.rollback()
+                logger.exception("Chat Save Error")
+
+    async def token_stream():
+        parts = []
+        try:
+            async for token in stream_ai_response(
+                db_history=history_for_ai,
+                new_user_message=chat_data.message,
+                user_role=user_role
+            ):
+                parts.append(token)
+                yield token
+        finally:
+            # Also runs when the client disconnects mid-stream: keep the partial reply.
+            # Shielded, since the disconnect cancels this task.
+            with anyio.CancelScope(shield=True):
+                await save_turn("".join(parts))
+
+    return StreamingResponse(
+        token_stream(),
+        media_type="text/plain; charset=utf-8",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # --- UPDATED VOICE ROUTE ---
 
 @router.post("/chat/voice", response_model=schemas.ChatHistoryRead)
@@ -411,7 +645,7 @@ async def send_voice_message(
     user_id: str = Form(...),
     session_id: str = Form(...),
     file: UploadFile = File(...),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     # 0. Validate Inputs
     if str(user_id).lower() in ["undefined", "null", "none"]:
@@ -423,7 +657,7 @@ async def send_voice_message(
         raise HTTPException(status_code=400, detail="Invalid User ID format")
 
     # 1. Fetch User & Role
-    user = db.query(models.User).filter(models.User.id == u_id).first()
+    user = await db.get(models.User, u_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -439,43 +673,32 @@ async def send_voice_message(
 
     try:
         # A. Save Temp Audio
-        with open(temp_audio_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+        audio_bytes = await _save_upload(file, temp_audio_path, keep=True)
 
         # B. Transcribe (Using New Whisper-Large-V3)
-        transcribed_text = await transcribe_audio(temp_audio_path)
+        transcribed_text = await transcribe_audio(temp_audio_path, audio_bytes)
+        del audio_bytes  # Drive uploads from the temp file
         if not transcribed_text or "Error" in transcribed_text:
             transcribed_text = "(Audio unintelligible)"
 
         # C. Save Transcript Temp
-        with open(temp_text_path, "w", encoding="utf-8") as f:
-            f.write(transcribed_text)
+        async with aiofiles.open(temp_text_path, "w", encoding="utf-8") as f:
+            await f.write(transcribed_text)
 
         # D. Upload to Google Drive (If Service Active)
         audio_drive_id = None
         audio_drive_link = None
 
         if drive_service:
-            # Upload Audio
-            audio_res = drive_service.upload_to_session_folder(
-                user_email=user_hash,
-                session_id=session_id,
-                file_path=temp_audio_path,
-                file_name=drive_audio_name,
+            # Upload Audio + Transcript Text concurrently (folders resolved once)
+            audio_res, _ = await drive_service.upload_many_to_session_folder(
+                user_hash, session_id,
+                [(temp_audio_path, drive_audio_name), (temp_text_path, drive_text_name)],
             )
             if audio_res:
                 audio_drive_id = audio_res.get("id")
                 audio_drive_link = audio_res.get("link")
 
-            # Upload Transcript Text
-            drive_service.upload_to_session_folder(
-                user_email=user_hash,
-                session_id=session_id,
-                file_path=temp_text_path,
-                file_name=drive_text_name,
-            )
-
         # E. Save Media Record to DB
         audio_db_record = models.MedicalMedia(
             patient_id=u_id,
@@ -486,7 +709,7 @@ async def send_voice_message(
             transcript=transcribed_text,
         )
         db.add(audio_db_record)
-        db.commit()
+        await db.commit()
 
     finally:
         # Cleanup Temp Files
@@ -494,10 +717,12 @@ async def send_voice_message(
         if os.path.exists(temp_text_path): os.remove(temp_text_path)
 
     # 3. Chat Logic
-    chat_record = db.query(models.ChatHistory).filter(
-        models.ChatHistory.session_id == session_id,
-        models.ChatHistory.patient_id == u_id,
-    ).first()
+    chat_record = (await db.execute(
+        select(models.ChatHistory).where(
+            models.ChatHistory.session_id == session_id,
+            models.ChatHistory.patient_id == u_id,
+        )
+    )).scalars().first()
 
     raw_history = chat_record.messages if chat_record and chat_record.messages else []
     
@@ -515,7 +740,7 @@ async def send_voice_message(
             user_role=user_role
         )
     except Exception as e:
-        print(f"AI Voice Error: {e}")
+        logger.exception("AI Voice Error")
         ai_text = "I'm having trouble connecting to the AI service."
 
     user_msg = {
@@ -531,19 +756,15 @@ async def send_voice_message(
     }
 
     if chat_record:
-        current_msgs = list(chat_record.messages) if chat_record.messages else []
-        current_msgs.append(user_msg)
-        current_msgs.append(ai_msg)
-        chat_record.messages = current_msgs
-        flag_modified(chat_record, "messages")
+        await _append_chat(db, chat_record, [user_msg, ai_msg])
+        await db.commit()
     else:
         chat_record = models.ChatHistory(
             patient_id=u_id, session_id=session_id, messages=[user_msg, ai_msg]
         )
         db.add(chat_record)
-
-    db.commit()
-    db.refresh(chat_record)
+        await db.commit()
+        await db.refresh(chat_record)
     return chat_record
 
 
@@ -556,16 +777,14 @@ async def generate_title_route(data: TitleInput):
 @router.post("/chat/autocomplete")
 async def autocomplete_endpoint(data: SuggestionInput):
     """Provides dynamic text suggestions."""
-    suggestions = await get_text_suggestions(data.text)
+    suggestions = await get_text_suggestions(data.text, session_id=data.session_id)
     return {"suggestions": suggestions}
 
 # --- USER & PROFILE ENDPOINTS ---
 
 @router.post("/users/", response_model=schemas.UserRead)
 def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    if db.query(models.User).filter(models.User.email == user.email).first():
-        raise HTTPException(status_code=400, detail="Email already registered")
-
+    # Duplicate emails are rejected by the UNIQUE index on users.email (no pre-check SELECT)
     final_role = models.UserRole.PATIENT
     final_provider_id = None
 
@@ -583,46 +802,66 @@ def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
 
     new_user = models.User(
         email=user.email,
-        hashed_password=user.password,
+        hashed_password=hash_password(user.password),
         role=final_role,
         provider_id=final_provider_id,
         has_signed_baa=user.has_signed_baa,
         is_2fa_enabled=user.is_2fa_enabled,
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
-
-    # UPDATED: Create PatientProfile
-    new_profile = models.PatientProfile(
-        user_id=new_user.id,
-        full_name=user.email.split("@")[0],
-        lifestyle_status=models.LifestyleEnum.NONE,
-        is_profile_complete=False
-    )
-    db.add(new_profile)
-    db.commit()
+    try:
+        db.flush()  # INSERT user -> id for the profile, same transaction
+
+        # UPDATED: Create PatientProfile
+        new_profile = models.PatientProfile(
+            user_id=new_user.id,
+            full_name=user.email.split("@")[0],
+            lifestyle_status=models.LifestyleEnum.NONE,
+            is_profile_complete=False
+        )
+        db.add(new_profile)
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Email already registered")
     db.refresh(new_user)
     return new_user
 
 @router.post("/login")
-def login(
+async def login(
+    request: Request,
     response: Response,
     user_credentials: schemas.UserLogin,
-    db: Session = Depends(get_db),
+    background: BackgroundTasks,
+    db: AsyncSession = Depends(get_async_db),
 ):
-    user = db.query(models.User).filter(models.User.email == user_credentials.email).first()
+    # Brute-force cap per account and per client
+    throttled = await asyncio.gather(
+        hit_rate_limit(f"login:e:{_email_key(user_credentials.email)}", *LOGIN_LIMIT_EMAIL),
+        hit_rate_limit(f"login:ip:{client_ip(request)}", *LOGIN_LIMIT_IP),
+    )
+    if any(throttled):
+        raise HTTPException(status_code=429, detail="Too many login attempts. Please try again later.")
+
+    user = (await db.execute(
+        select(models.User).where(models.User.email == user_credentials.email)
+    )).scalar_one_or_none()
     
-    if not user or user_credentials.password != user.hashed_password:
+    if not user or not await asyncio.to_thread(verify_password, user_credentials.password, user.hashed_password):
         raise HTTPException(status_code=403, detail="Invalid Credentials")
 
+    # Legacy plaintext / outdated parameters: upgrade the stored hash now that we know the password
+    if password_needs_rehash(user.hashed_password):
+        user.hashed_password = await asyncio.to_thread(hash_password, user_credentials.password)
+        await db.commit()
+
     # 2FA Logic...
     if user.is_2fa_enabled:
         otp = "".join(secrets.choice(string.digits) for _ in range(6))
         user.otp_code = otp
         user.otp_expiry = datetime.utcnow() + timedelta(minutes=5)
-        db.commit()
-        send_otp_email(user.email, otp)
+        await db.commit()
+        background.add_task(send_otp_email, user.email, otp)  # SMTP after the reply
         return {
             "status": "2fa_required",
             "user_id": user.id,
@@ -630,44 +869,22 @@ def login(
         }
 
     # Standard Login
-    user_hash = create_stable_hash(user.email)
-    
-    # Set Secure Cookies
-    response.set_cookie(key="user_role", value=user.role.value.upper(), httponly=True)
-    response.set_cookie(key="user_hash", value=user_hash, httponly=True)
-    response.set_cookie(key="user_id", value=str(user.id), httponly=True)
-
-    redirect_url = "/dashboard"
-    if user.role == models.UserRole.PATIENT:
-        redirect_url = f"/app/{user_hash}"
-    elif user.role == models.UserRole.DOCTOR:
-        redirect_url = f"/doctor-app/{user_hash}"
-    elif user.role == models.UserRole.ADMIN:
-        redirect_url = "/admin"
-
-    return {
-        "status": "success",
-        "id": user.id,
-        "role": user.role,
-        "email": user.email,
-        "hash": user_hash, # Send hash for frontend
-        "redirect_url": redirect_url,
-    }
+    return finalize_login(user, response)
 
 # --- NEW ROUTE: VERIFY OTP ---
 @router.post("/auth/verify-2fa")
-def verify_2fa_login(
+async def verify_2fa_login(
     response: Response,
     data: schemas.VerifyOTPInput,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    user = db.query(models.User).filter(models.User.id == data.user_id).first()
+    user = await db.get(models.User, data.user_id)
 
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
     # 1. Validate OTP
-    if not user.otp_code or user.otp_code != data.otp_code:
+    if not user.otp_code or not secrets.compare_digest(user.otp_code.encode(), str(data.otp_code).encode()):
         raise HTTPException(status_code=400, detail="Invalid OTP code")
 
     # 2. Validate Expiry
@@ -677,7 +894,7 @@ def verify_2fa_login(
     # 3. Clear OTP after success
     user.otp_code = None
     user.otp_expiry = None
-    db.commit()
+    await db.commit()
 
     # 4. Finalize Login
     return finalize_login(user, response)
@@ -692,28 +909,28 @@ async def serve_user_app(user_hash: str, request: Request, db: Session = Depends
     #     return RedirectResponse("/access-denied")
     
     if not user:
-        print("DEBUG: Access Denied - No User Found in Cookie")
+        logger.debug("Access Denied - No User Found in Cookie")
         return RedirectResponse("/access-denied")
         
     if not verify_route_access(user, user_hash):
-        print(f"DEBUG: Access Denied - Hash Mismatch for {user.email}")
+        logger.debug("Access Denied - Hash Mismatch for %s", user.email)
         return RedirectResponse("/access-denied")
         
     return templates.TemplateResponse("website/home.html", {"request": request})
 
 @router.get("/app/{user_hash}/profile", response_class=HTMLResponse)
 async def serve_profile_page(user_hash: str, request: Request, db: Session = Depends(get_db)):
-    # 1. Security Check
-    user = get_current_user_from_cookie(request, db)
+    # 1. Security Check (profiles come back with the same query)
+    user = get_current_user_from_cookie(request, db, *PROFILE_LOAD)
     if not user or not verify_route_access(user, user_hash):
         return RedirectResponse("/access-denied")
 
     # 2. Fetch Profiles
-    profile = db.query(models.PatientProfile).filter(models.PatientProfile.user_id == user.id).first()
+    profile = user.patient_profile
     doctor_profile = None
     
     if user.role == models.UserRole.DOCTOR:
-        doctor_profile = db.query(models.DoctorProfile).filter(models.DoctorProfile.user_id == user.id).first()
+        doctor_profile = user.doctor_profile
         if not doctor_profile:
             doctor_profile = models.DoctorProfile(user_id=user.id)
             db.add(doctor_profile)
@@ -731,13 +948,13 @@ async def serve_profile_page(user_hash: str, request: Request, db: Session = Dep
 
 @router.post("/app/{user_hash}/profile/update")
 async def update_profile(user_hash: str, data: dict, request: Request, db: Session = Depends(get_db)):
-    # 1. Security Check
-    user = get_current_user_from_cookie(request, db)
+    # 1. Security Check (profiles come back with the same query)
+    user = get_current_user_from_cookie(request, db, *PROFILE_LOAD)
     if not user or not verify_route_access(user, user_hash):
         raise HTTPException(status_code=403, detail="Unauthorized Access")
 
     # 2. Update Patient Profile
-    profile = db.query(models.PatientProfile).filter(models.PatientProfile.user_id == user.id).first()
+    profile = user.patient_profile
     if profile:
         profile.full_name = data.get('full_name', profile.full_name)
         profile.phone = data.get('phone', profile.phone)
@@ -765,20 +982,34 @@ async def update_profile(user_hash: str, data: dict, request: Request, db: Sessi
 
     # 3. Update Doctor Profile (if applicable)
     if user.role == models.UserRole.DOCTOR:
-        doc = db.query(models.DoctorProfile).filter(models.DoctorProfile.user_id == user.id).first()
+        doc = user.doctor_profile
         if doc:
             doc.bio = data.get('bio', doc.bio)
             if 'specialty' in data: doc.specialty = data['specialty']
             if 'is_available' in data: doc.is_available = data['is_available']
 
     db.commit()
+    invalidate_cookie_user(user.id)
+    await clear_profile_percent(f"{user.id}:{user_hash}")
     return {"status": "updated"}
 
 # 3. Check Completion Status
 @router.get("/app/{user_hash}/profile/status")
 async def check_profile_status(user_hash: str, request: Request, db: Session = Depends(get_db)):
+    # 0. Cache: keyed by cookie user + URL hash, and only ever stored after the
+    # security check below passed for that exact pair (so a hit needs no DB at all)
+    cache_key = f"{request.cookies.get('user_id')}:{user_hash}"
+    cached = await get_profile_percent(cache_key)
+    if cached is not None:
+        return {"percent": cached}
+
     # 1. Security Check
-    user = get_current_user_from_cookie(request, db)
+    user = get_current_user_from_cookie(
+        request, db,
+        joinedload(models.User.patient_profile).options(
+            undefer(models.PatientProfile.address), undefer(models.PatientProfile.allergies)
+        ),
+    )
     if not user or not verify_route_access(user, user_hash):
         return {"percent": 0} 
 
@@ -793,34 +1024,63 @@ async def check_profile_status(user_hash: str, request: Request, db: Session = D
         filled_fields += sum(1 for f in fields if f)
 
     percent = int((filled_fields / total_fields) * 100) if total_fields > 0 else 0
+    await set_profile_percent(cache_key, percent)
     return {"percent": percent}
 
 @router.get("/medical_media/", response_model=List[schemas.MediaRead])
-def read_medical_media(db: Session = Depends(get_db)):
-    return db.query(models.MedicalMedia).all()
+def read_medical_media(
+    request: Request,
+    limit: int = Query(50, ge=1, le=200),
+    offset: int = Query(0, ge=0),
+    session_id: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    user = get_current_user_from_cookie(request, db)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not logged in")
+
+    # MediaRead includes the (deferred) transcript: load it in the same SELECT
+    query = (
+        db.query(models.MedicalMedia)
+        .options(undefer(models.MedicalMedia.transcript))
+        .filter(models.MedicalMedia.patient_id == user.id)
+    )
+    if session_id:
+        query = query.filter(models.MedicalMedia.session_id == session_id)
+    return query.order_by(models.MedicalMedia.created_at.desc()).offset(offset).limit(limit).all()
 
 
 # --- DOCTOR & DRIVE ROUTES (Unchanged Logic, just DB Names) ---
 
+# Dashboard counts: one SELECT of scalar subqueries, shared by all doctors for 30s
+DASHBOARD_COUNTS = select(
+    select(func.count()).select_from(models.User).scalar_subquery(),
+    select(func.count()).select_from(models.ChatHistory).scalar_subquery(),
+    select(func.count()).select_from(models.MedicalMedia).scalar_subquery(),
+)
+_dashboard_stats = TTLCache(maxsize=1, ttl=30)
+
 @router.get("/doctor-app/{user_hash}", response_class=HTMLResponse)
 async def serve_doctor_dashboard(user_hash: str, request: Request):
     if not verify_access(request, allowed_roles=["DOCTOR"], required_hash=user_hash):
         return RedirectResponse("/access-denied")
 
-    db = SessionLocal()
-    try:
+    stats = _dashboard_stats.get("stats")
+    if stats is None:
+        # All three counts in one round trip
+        async with AsyncSessionLocal() as db:
+            users, chats, files = (await db.execute(DASHBOARD_COUNTS)).one()
         stats = {
-            "total_users": db.query(models.User).count(),
-            "total_chats": db.query(models.ChatHistory).count(),
-            "total_files": db.query(models.MedicalMedia).count(),
+            "total_users": users,
+            "total_chats": chats,
+            "total_files": files,
             "last_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         }
-        return templates.TemplateResponse(
-            "doctor/base.html",
-            {"request": request, "stats": stats, "user_hash": user_hash},
-        )
-    finally:
-        db.close()
+        _dashboard_stats["stats"] = stats
+    return templates.TemplateResponse(
+        "doctor/base.html",
+        {"request": request, "stats": stats, "user_hash": user_hash},
+    )
 
 @router.get("/doctor-app/{user_hash}/files", response_class=HTMLResponse)
 async def serve_doctor_files(user_hash: str, request: Request):
@@ -829,26 +1089,18 @@ async def serve_doctor_files(user_hash: str, request: Request):
 
     drive_files = []
     if drive_service:
-        try:
-            drive_files = (
-                drive_service.service.files()
-                .list(
-                    pageSize=20,
-                    fields="nextPageToken, files(id, name, mimeType, webViewLink, createdTime)",
-                )
-                .execute()
-                .get("files", [])
-            )
-        except Exception as e:
-            print(f"Error fetching from Drive: {e}")
+        drive_files = await drive_service.list_recent_files(page_size=20)
 
     return templates.TemplateResponse(
         "admin/doctor_files.html",
         {"request": request, "files": drive_files, "user_hash": user_hash},
     )
 
+FILES_API_EXCLUDE = "not (name contains 'Recording_' and mimeType='text/plain')"
+FILES_API_FIELDS = "files(id, name, mimeType, webViewLink, iconLink, createdTime)"
+
 @router.get("/app/{user_hash}/files-api")
-def list_user_files(user_hash: str, request: Request, db: Session = Depends(get_db)):
+async def list_user_files(user_hash: str, request: Request, db: Session = Depends(get_db)):
     # 1. Security Check
     user = get_current_user_from_cookie(request, db)
     if not user or not verify_route_access(user, user_hash):
@@ -857,51 +1109,49 @@ def list_user_files(user_hash: str, request: Request, db: Session = Depends(get_
     if not drive_service: return []
     
     # 2. Use the hash to get files (assuming your Drive logic stores folders by hash)
-    raw_files = drive_service.get_all_files_for_user(user_hash)
-    
-    cleaned_files = []
-    for f in raw_files:
-        # Filter out temp transcripts/recordings from the UI list if desired
-        if f['name'].endswith('.txt') and 'Recording_' in f['name']:
-            continue
-            
-        cleaned_files.append({
-            "id": f['id'],
-            "name": f['name'],
-            "mimeType": f['mimeType'],
-            "webViewLink": f['webViewLink'],
-            "iconLink": f.get('iconLink'),
-            "createdTime": f.get('createdTime')
-        })
-        
-    cleaned_files.sort(key=lambda x: x['createdTime'], reverse=True)
-    return cleaned_files
+    # Voice transcripts (Recording_*.txt) are filtered by Drive itself, and only the
+    # fields the UI needs come back, so the rows are returned as-is
+    # Already newest first (Drive orderBy)
+    return await drive_service.get_all_files_for_user(user_hash, extra_q=FILES_API_EXCLUDE, fields=FILES_API_FIELDS)
 
 @router.delete("/files/{drive_file_id}")
-def delete_file_drive(drive_file_id: str, db: Session = Depends(get_db)):
+async def delete_file_drive(drive_file_id: str, db: AsyncSession = Depends(get_async_db)):
+    async def _delete_row():
+        # Single DELETE statement: no SELECT / ORM hydration first
+        await db.execute(delete(models.MedicalMedia).where(models.MedicalMedia.drive_file_id == drive_file_id))
+        await db.commit()
+
+    # Drive call and DB delete are independent: latency is max(drive, db) instead of the sum
+    jobs = [_delete_row()]
     if drive_service:
-        drive_service.delete_file(drive_file_id)
+        jobs.append(drive_service.delete_file(drive_file_id))
+    await asyncio.gather(*jobs)
 
-    db_record = db.query(models.MedicalMedia).filter(models.MedicalMedia.drive_file_id == drive_file_id).first()
-    if db_record:
-        db.delete(db_record)
-        db.commit()
-        
     return {"status": "deleted", "id": drive_file_id}
 
+# Doctor chat review: newest first, one page at a time (keyset on id)
+DOCTOR_CHATS_PAGE = 50
+
 @router.get("/doctor-app/{user_hash}/chats", response_class=HTMLResponse)
-async def serve_doctor_chats(user_hash: str, request: Request):
+async def serve_doctor_chats(user_hash: str, request: Request, before_id: Optional[int] = Query(None)):
     if not verify_access(request, allowed_roles=["DOCTOR"], required_hash=user_hash):
         return RedirectResponse("/access-denied")
 
     db = SessionLocal()
     try:
-        chats = (
-            db.query(models.ChatHistory).order_by(models.ChatHistory.id.desc()).all()
+        # The page renders every transcript inline, so messages are loaded, but only for this page.
+        # Patient email comes in the same query (many-to-one join) instead of one SELECT per chat.
+        q = db.query(models.ChatHistory).options(
+            load_only(models.ChatHistory.id, models.ChatHistory.session_id, models.ChatHistory.messages),
+            joinedload(models.ChatHistory.patient).load_only(models.User.email),
         )
+        if before_id is not None:
+            q = q.filter(models.ChatHistory.id < before_id)
+        chats = q.order_by(models.ChatHistory.id.desc()).limit(DOCTOR_CHATS_PAGE).all()
+        next_before = chats[-1].id if len(chats) == DOCTOR_CHATS_PAGE else None
         return templates.TemplateResponse(
             "admin/doctor_chats.html",
-            {"request": request, "chats": chats, "user_hash": user_hash},
+            {"request": request, "chats": chats, "user_hash": user_hash, "next_before": next_before},
         )
     finally:
         db.close()
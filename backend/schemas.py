@@ -130,6 +130,7 @@ class TitleInput(BaseModel):
 
 class SuggestionInput(BaseModel):
     text: str
+    session_id: Optional[str] = None
 
 class VerifyOTPInput(BaseModel):
     user_id: int
@@ -1,11 +1,16 @@
 import os
+import logging
 from fastapi import Request,HTTPException, Response
 from fastapi.templating import Jinja2Templates 
 from starlette.responses import RedirectResponse 
-from db import SessionLocal
+from db import SessionLocal, AsyncSessionLocal
 from sqladmin.authentication import AuthenticationBackend
-from drive_service import DriveAPI
+from drive_service import DriveAPI, AsyncDriveAPI
 import hashlib
+import secrets
+import functools
+import threading
+import time
 import models
 import smtplib
 import ssl
@@ -13,10 +18,15 @@ import socket
 from email.message import EmailMessage
 from sqlalchemy.orm import Session
 import string
+from cachetools import LRUCache, TTLCache
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # --- IPv4 Force Fix for Render ---
 # --- IPv4 Force Fix for Render (Updated) ---
 class SMTP_SSL_IPv4(smtplib.SMTP_SSL):
@@ -49,8 +59,9 @@ static_dir = os.path.join(frontend_dir, "static")
 templates = Jinja2Templates(directory=templates_dir)
 
 # Initialize Drive (So routes.py and views.py can use it)
+# One shared instance app-wide; the async facade keeps Drive I/O off the event loop
 try:
-    drive_service = DriveAPI()
+    drive_service = AsyncDriveAPI(DriveAPI())
     print("Google Drive Service Initialized")
 except Exception as e:
     print(f"Warning: Drive Service failed: {e}")
@@ -63,6 +74,10 @@ def get_db():
     try: yield db
     finally: db.close()
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
 def is_system_message(content): return False 
 
 def sanitize_message_content(content): return str(content) if content else ""
@@ -78,6 +93,7 @@ def generate_user_hash(email: str) -> str:
     return hashlib.sha256(raw_string.encode()).hexdigest()[:15]
 
 # --- STABLE HASH FUNCTION (Fixes Redirect Loop) ---
+@functools.lru_cache(maxsize=8192)  # pure email -> hash, hit on every auth/route check
 def create_stable_hash(email: str) -> str:
     """
     Creates a deterministic hash based on email.
@@ -102,37 +118,143 @@ async def check_admin_access(request: Request, call_next):
             
     return await call_next(request)
 
+# --- SHARED REDIS (optional) ---
+# Used for rate limiting and small per-user caches. Without REDIS_URL each worker
+# falls back to in-process state.
+try:
+    import redis
+    import redis.asyncio as aioredis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = aioredis.from_url(REDIS_URL, socket_timeout=0.5) if REDIS_AVAILABLE and REDIS_URL else None
+
+# --- RATE LIMITING ---
+# Fixed windows quantized to the clock (key includes time // window), counted with
+# INCR + EXPIRE in one round trip.
+RATE_KEY_PREFIX = "rl:"
+_rate_local = LRUCache(maxsize=65536)  # stale windows simply age out
+
+async def hit_rate_limit(key: str, limit: int, window: int) -> bool:
+    """
+    Counts one hit for 'key' in the current window.
+    Returns True once the count goes over 'limit' (caller should throttle).
+    """
+    bucket = f"{RATE_KEY_PREFIX}{key}:{int(time.time()) // window}"
+    if redis_client is not None:
+        try:
+            count, _ = await redis_client.pipeline(transaction=False).incr(bucket).expire(bucket, window).execute()
+            return count > limit
+        except redis.RedisError as e:
+            logger.warning("Rate limit Redis error, counting locally: %s", e)
+    count = _rate_local.get(bucket, 0) + 1
+    _rate_local[bucket] = count
+    return count > limit
+
+# --- PROFILE COMPLETION CACHE ---
+# user -> completion percent; only changes via /profile/update, which invalidates it.
+# The TTL bounds staleness from edits made elsewhere (admin panel, other workers' local caches).
+PROFILE_PCT_PREFIX = "profpct:"
+PROFILE_PCT_TTL = 3600
+_profile_pct_local = TTLCache(maxsize=16384, ttl=PROFILE_PCT_TTL)
+
+async def get_profile_percent(key: str):
+    """Cached completion percent for 'key', or None on a miss."""
+    if redis_client is not None:
+        try:
+            v = await redis_client.get(f"{PROFILE_PCT_PREFIX}{key}")
+            return int(v) if v is not None else None
+        except redis.RedisError as e:
+            logger.warning("Profile cache Redis error: %s", e)
+    return _profile_pct_local.get(key)
+
+async def set_profile_percent(key: str, percent: int):
+    _profile_pct_local[key] = percent
+    if redis_client is not None:
+        try:
+            await redis_client.set(f"{PROFILE_PCT_PREFIX}{key}", percent, ex=PROFILE_PCT_TTL)
+        except redis.RedisError as e:
+            logger.warning("Profile cache Redis error: %s", e)
+
+async def clear_profile_percent(key: str):
+    _profile_pct_local.pop(key, None)
+    if redis_client is not None:
+        try:
+            await redis_client.delete(f"{PROFILE_PCT_PREFIX}{key}")
+        except redis.RedisError as e:
+            logger.warning("Profile cache Redis error: %s", e)
+
+def client_ip(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+# --- PASSWORD HASHING (argon2id) ---
+# ~tens of ms of CPU per hash/verify: async routes call these via asyncio.to_thread
+password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=1)
+
+def hash_password(password: str) -> str:
+    return password_hasher.hash(password)
+
+def verify_password(password: str, stored: str) -> bool:
+    """
+    Checks a login password against the stored value.
+    Accounts created before hashing still hold plaintext: compared in constant time
+    (password_needs_rehash() tells the caller to upgrade them).
+    """
+    if not stored:
+        return False
+    if not stored.startswith("$argon2"):
+        return secrets.compare_digest(password.encode(), stored.encode())
+    try:
+        return password_hasher.verify(stored, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def password_needs_rehash(stored: str) -> bool:
+    return not stored.startswith("$argon2") or password_hasher.check_needs_rehash(stored)
+
 def is_email_allowed(email: str) -> bool:
     # Example logic: Allow only specific domains or check a DB list
     allowed_domains = ["gmail.com", "outlook.com"] 
     return True # Default to True for now
 
-def finalize_login(user, response: Response):
+# Post-login landing page per role ({h} = user hash)
+ROLE_REDIRECT = {
+    models.UserRole.PATIENT: "/app/{h}",
+    models.UserRole.DOCTOR: "/doctor-app/{h}",
+    models.UserRole.ADMIN: "/admin",
+}
+
+def redirect_for(role, user_hash: str) -> str:
+    return ROLE_REDIRECT.get(role, "/dashboard").format(h=user_hash)
+
+def set_login_cookies(user, response: Response) -> str:
     """
-    Sets cookies and determines redirect URL.
-    Used by both standard login and 2FA verification.
+    Sets the session cookies (user_id is what secure lookups use) and returns the user hash.
+    Shared by every login path.
     """
     user_hash = create_stable_hash(user.email)
+    invalidate_cookie_user(user.id)  # fresh session: don't serve a pre-login cached copy
 
-    # Set Secure Cookies
     response.set_cookie(key="user_role", value=user.role.value.upper(), httponly=True)
     response.set_cookie(key="user_hash", value=user_hash, httponly=True)
+    response.set_cookie(key="user_id", value=str(user.id), httponly=True)
+    return user_hash
 
-    # Determine Redirect
-    redirect_url = "/dashboard"
-    if user.role == models.UserRole.PATIENT:
-        redirect_url = f"/app/{user_hash}"
-    elif user.role == models.UserRole.DOCTOR:
-        redirect_url = f"/doctor-app/{user_hash}"
-    elif user.role == models.UserRole.ADMIN:
-        redirect_url = "/admin"
-
+def finalize_login(user, response: Response):
+    """
+    Sets cookies and determines redirect URL.
+    Used by both standard login and 2FA verification.
+    """
+    user_hash = set_login_cookies(user, response)
     return {
         "status": "success",
         "id": user.id,
         "role": user.role,
         "email": user.email,
-        "redirect_url": redirect_url,
+        "hash": user_hash, # Send hash for frontend
+        "redirect_url": redirect_for(user.role, user_hash),
     }
 
 def send_otp_email(receiver_email: str, otp: str):
@@ -212,20 +334,44 @@ def send_reset_link(receiver_email: str, link: str):
         return False
 
 # --- HELPER: Secure User Retrieval ---
-def get_current_user_from_cookie(request: Request, db: Session) -> models.User:
+# user_id -> (user_hash cookie, detached User). Short TTL: repeat page loads skip the
+# lookup, role/email edits made elsewhere (admin panel) show up within a minute.
+# Only plain lookups are cached; callers passing loader options need live relationships.
+_cookie_user_cache = TTLCache(maxsize=10000, ttl=60)
+_cookie_user_lock = threading.Lock()
+
+def invalidate_cookie_user(user_id):
+    """Drops the cached cookie user (call after login / profile changes)."""
+    with _cookie_user_lock:
+        _cookie_user_cache.pop(int(user_id), None)
+
+def get_current_user_from_cookie(request: Request, db: Session, *options) -> models.User:
     """
     Retrieves the logged-in user via the secure 'user_id' cookie.
     This prevents users from simply changing the URL hash to access others' data.
+    Optional loader options (e.g. joinedload) are applied to the same query.
     """
     uid_str = request.cookies.get("user_id")
     if not uid_str:
-        print(f"DEBUG: Missing user_id cookie. Cookies found: {request.cookies.keys()}")
+        logger.debug("Missing user_id cookie. Cookies found: %s", request.cookies.keys())
         return None
     try:
-        user = db.query(models.User).filter(models.User.id == int(uid_str)).first()
+        uid = int(uid_str)
+        cookie_hash = request.cookies.get("user_hash")
+        if not options:
+            with _cookie_user_lock:
+                hit = _cookie_user_cache.get(uid)
+            if hit is not None and hit[0] == cookie_hash:
+                return hit[1]
+
+        user = db.query(models.User).options(*options).filter(models.User.id == uid).first()
+        if user is not None and not options:
+            db.expunge(user)  # cached copy must not stay bound to this request's session
+            with _cookie_user_lock:
+                _cookie_user_cache[uid] = (cookie_hash, user)
         return user
-    except:
-        print(f"DEBUG: Error fetching user: {e}")
+    except Exception as e:
+        logger.exception("Error fetching user")
         return None
 
 def verify_route_access(user: models.User, url_hash: str) -> bool:
@@ -236,8 +382,8 @@ def verify_route_access(user: models.User, url_hash: str) -> bool:
         return False
     # Verify the URL hash matches the user's generated hash
     expected_hash = create_stable_hash(user.email)
-    if expected_hash != url_hash:
-        print(f"DEBUG: Hash Mismatch! Expected: {expected_hash}, Got: {url_hash}")
+    if not secrets.compare_digest(expected_hash.encode(), (url_hash or "").encode()):
+        logger.debug("Hash Mismatch! Expected: %s, Got: %s", expected_hash, url_hash)
         return False
     
     return True
@@ -256,7 +402,7 @@ def verify_access(
         return False
 
     if required_hash:
-        if current_hash != required_hash:
+        if not secrets.compare_digest((current_hash or "").encode(), required_hash.encode()):
             return False 
 
     return True
@@ -1,5 +1,7 @@
 from fastapi import Request
 from datetime import datetime
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
 
 # FastAPI Admin Imports
 from sqladmin import ModelView, BaseView, expose
@@ -23,6 +25,13 @@ class UserAdmin(ModelView, model=models.User):
     icon = "fa-solid fa-user"
     category = "User Management"
 
+    # Batch the one-to-one profiles (1 query per page instead of 1 per row)
+    def list_query(self, request: Request):
+        return select(models.User).options(
+            selectinload(models.User.patient_profile),
+            selectinload(models.User.doctor_profile),
+        )
+
 # UPDATED: Renamed from ProfileAdmin to PatientProfileAdmin
 class PatientProfileAdmin(ModelView, model=models.PatientProfile):
     column_list = [
@@ -38,6 +47,9 @@ class PatientProfileAdmin(ModelView, model=models.PatientProfile):
     name = "Patient Profile"
     name_plural = "Patient Profiles"
 
+    def list_query(self, request: Request):
+        return select(models.PatientProfile).options(selectinload(models.PatientProfile.user))
+
 # NEW: Doctor Profile View
 class DoctorProfileAdmin(ModelView, model=models.DoctorProfile):
     column_list = [
@@ -51,6 +63,9 @@ class DoctorProfileAdmin(ModelView, model=models.DoctorProfile):
     name = "Doctor Profile"
     name_plural = "Doctor Profiles"
 
+    def list_query(self, request: Request):
+        return select(models.DoctorProfile).options(selectinload(models.DoctorProfile.user))
+
 # NEW: Medical Session View (The "Dynamic" Data)
 class MedicalSessionAdmin(ModelView, model=models.MedicalSession):
     column_list = [
@@ -123,13 +138,7 @@ class AnalyticsView(BaseView):
     async def files_page(self, request: Request):
         drive_files = []
         if drive_service:
-            try:
-                drive_files = drive_service.service.files().list(
-                    pageSize=20, 
-                    fields="nextPageToken, files(id, name, mimeType, webViewLink, createdTime)"
-                ).execute().get('files', [])
-            except Exception as e:
-                print(f"Error fetching from Drive: {e}")
+            drive_files = await drive_service.list_recent_files(page_size=20)
 
         return await self.templates.TemplateResponse(
             request=request, name="admin/admin_files.html", context={"files": drive_files}
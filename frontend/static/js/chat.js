@@ -131,7 +131,7 @@ function handleInput(textarea) {
                 const res = await fetch(`${API_URL}/chat/autocomplete`, {
                     method: "POST",
                     headers: { "Content-Type": "application/json" },
-                    body: JSON.stringify({ text: val })
+                    body: JSON.stringify({ text: val, session_id: currentSessionId })
                 });
                 
                 if(res.ok) {
@@ -307,6 +307,7 @@ function appendMessageToUI(role, text, thought = null, rawText = null) {
 
     row.appendChild(content);
     chatContent.appendChild(row);
+    return row;
 }
 
 // Helper for creating action buttons
@@ -561,7 +562,8 @@ async function sendMessage(presetMessage = null) {
         // Trigger Title Auto-Gen (Fire and forget)
         updateChatTitle(text || "Medical File Upload");
 
-        const res = await fetch(`${API_URL}/chat/send`, {
+        // Streamed reply: render tokens as they arrive instead of waiting for the full answer
+        const res = await fetch(`${API_URL}/chat/stream`, {
             method: "POST",
             headers: { "Content-Type": "application/json" },
             body: JSON.stringify({
@@ -571,16 +573,33 @@ async function sendMessage(presetMessage = null) {
             })
         });
 
-        if (!res.ok) throw new Error("Message send failed");
-        const responseData = await res.json();
-
-        // --- STEP C: RENDER AI RESPONSE ---
-        document.getElementById(loadingId).remove();
+        if (!res.ok || !res.body) throw new Error("Message send failed");
+
+        // --- STEP C: RENDER AI RESPONSE (progressively) ---
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder();
+        let aiText = "";
+        let aiBody = null;
+
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            aiText += decoder.decode(value, { stream: true });
+            if (!aiBody) {
+                document.getElementById(loadingId).remove();
+                aiBody = appendMessageToUI("assistant", aiText).querySelector(".markdown-body");
+            } else {
+                aiBody.innerHTML = parseMarkdown(aiText);
+            }
+            scrollToBottom();
+        }
+        aiText += decoder.decode();
 
-        if (responseData && responseData.messages) {
-            const msgs = responseData.messages;
-            const aiMsg = msgs[msgs.length - 1];
-            appendMessageToUI("assistant", aiMsg.content);
+        if (!aiBody) {
+            document.getElementById(loadingId).remove();
+            appendMessageToUI("assistant", aiText);
+        } else {
+            aiBody.innerHTML = parseMarkdown(aiText);
         }
 
     } catch (error) {